@@ -0,0 +1,44 @@
+import * as apigateway from "aws-cdk-lib/aws-apigateway";
+import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
+import * as lambda from "aws-cdk-lib/aws-lambda";
+import { Construct } from "constructs";
+import { ApiGatewayDynamoDb } from "./dynamodb-apigateway";
+
+//Construct to create the job status table and its query API
+interface JobStatusApiConstructProps {
+  readonly apiGW: apigateway.RestApi;
+  readonly apiGWPath: string;
+  readonly apiAuthorizer: apigateway.IAuthorizer;
+  // Functions writing the lifecycle of the jobs (JOBS_TABLE environment variable)
+  readonly writers: lambda.Function[];
+}
+
+export class JobStatusApi extends Construct {
+  public readonly table: dynamodb.Table;
+
+  constructor(scope: Construct, id: string, props: JobStatusApiConstructProps) {
+    super(scope, id);
+
+    // One item per job: status, timings, input/output sizes, encoder fps
+    // GET /jobs, GET /jobs/{job_id}, GET /jobs/video_id/{video_id}, GET /jobs/status/{status}
+    const jobsApi = new ApiGatewayDynamoDb(this, "JobStatusTable", {
+      apiGW: props.apiGW,
+      apiGWPath: props.apiGWPath,
+      tableName: "ffmpeg-jobs",
+      partitionKey: "job_id",
+      // Writes follow the submissions: bursts during bulk ingests
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      globalIndexes: [
+        { indexName: "video_id", partitionKey: "video_id", sortKey: "updated_at" },
+        { indexName: "status", partitionKey: "status", sortKey: "updated_at" },
+      ],
+      apiAuthorizer: props.apiAuthorizer,
+    });
+    this.table = jobsApi.table;
+
+    for (const writer of props.writers) {
+      this.table.grantReadWriteData(writer);
+      writer.addEnvironment("JOBS_TABLE", this.table.tableName);
+    }
+  }
+}
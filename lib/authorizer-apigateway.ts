@@ -3,6 +3,7 @@ import { join } from "path";
 import * as cdk from "aws-cdk-lib";
 import * as lambda from "aws-cdk-lib/aws-lambda";
 import * as apigateway from "aws-cdk-lib/aws-apigateway";
+import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
 
 //Construct to create a API Gateway using token Authorizer, green Header
 interface LambdaApiGatewayConstructProps {
@@ -15,6 +16,8 @@ export class LambdaApi extends Construct {
   public readonly apiLambda: apigateway.RestApi;
   public readonly apiRoot: apigateway.Resource;
   public readonly authorizerToken: apigateway.TokenAuthorizer;
+  // API keys: one item per SHA-256 hash of a token, with the tenant settings
+  public readonly apiKeysTable: dynamodb.Table;
 
   constructor(
     scope: Construct,
@@ -48,6 +51,16 @@ export class LambdaApi extends Construct {
       "ffmpeg-auth"
     );
 
+    this.apiKeysTable = new dynamodb.Table(this, "ApiKeysTable", {
+      tableName: "ffmpeg-api-keys",
+      partitionKey: {
+        name: "key_hash",
+        type: dynamodb.AttributeType.STRING,
+      },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: cdk.RemovalPolicy.RETAIN,
+    });
+
     // Create new Lambda function to authorize the Lambda
     const authorizerFunction = new lambda.Function(
       this,
@@ -60,15 +73,21 @@ export class LambdaApi extends Construct {
         runtime: lambda.Runtime.PYTHON_3_8,
         handler: "index.lambda_handler",
         code: lambda.Code.fromAsset(myAuthorizerLambdaFilePath), // Path to your Lambda code
+        environment: {
+          API_KEYS_TABLE: this.apiKeysTable.tableName,
+          KEY_CACHE_TTL: "300",
+          KEY_CACHE_MAX_ENTRIES: "10000",
+        },
       }
     );
+    this.apiKeysTable.grantReadData(authorizerFunction);
 
     // Create the Lambda authorizer and attach it to the RestApi
     this.authorizerToken = new apigateway.TokenAuthorizer(this, "Authorizer", {
       handler: authorizerFunction,
       identitySource: `method.request.header.${props.tokenHeader}`,
-      resultsCacheTtl: cdk.Duration.days(0),
-      
+      // The policy covers the whole stage: one decision per token is reused for every method
+      resultsCacheTtl: cdk.Duration.minutes(5),
     });
     // Set the default authorizer for all methods
     this.apiLambda.root.addMethod("ANY", new apigateway.MockIntegration(), {
@@ -7,6 +7,8 @@ import { s3CloudFront } from "./s3-cloudfront";
 import { apiLambdaIntegation } from "./lambda-post-apigateway";
 import { stepFunctionWorker } from "./stepfunction-worker";
 import { S3EventLambda } from "./s3-event-lambda";
+import { JobStatusApi } from "./api-endpoints";
+import { JobScheduler } from "./job-scheduler";
 
 export class CdkFFMpegLambdaStack extends cdk.Stack {
   constructor(scope: Construct, id: string, props?: cdk.StackProps) {
@@ -35,11 +37,14 @@ export class CdkFFMpegLambdaStack extends cdk.Stack {
 
     /** ------------------ Creating the Step Function Workflow ------------------ */
 
+    // ffmpeg-execute invocations running at the same time (Step Function, chunks and synchronous jobs)
+    const maxFfmpegInvocations = 50;
     const stepFunction = new stepFunctionWorker(
       this,
       "StepFunctionFFMPEG",{
         s3BucketOutput: S3BucketCloudFront.s3BucketOutput,
-        cloudFrontOutput: S3BucketCloudFront.cloudFrontOutput
+        cloudFrontOutput: S3BucketCloudFront.cloudFrontOutput,
+        maxConcurrentInvocations: maxFfmpegInvocations
       }
     );
 
@@ -72,6 +77,9 @@ export class CdkFFMpegLambdaStack extends cdk.Stack {
         environment: {
           CLOUDFRONT_HOSTNAME: "https://"+S3BucketCloudFront.cloudFrontOutput.domainName,
           BUCKET_NAME: S3BucketCloudFront.s3BucketOutput.bucketName,
+          // Synchronous mode: short jobs invoke ffmpeg-execute directly
+          EXECUTE_FUNCTION_NAME: stepFunction.executeFunctionOutput.functionName,
+          SYNC_MAX_SECONDS: "20",
         },
         
       }
@@ -88,6 +96,35 @@ export class CdkFFMpegLambdaStack extends cdk.Stack {
     stepFunction.stepFunctionOutput.grantStartExecution(
       submiJobIntegration.functionOutput
     );
+    // Synchronous jobs are run by invoking ffmpeg-execute
+    stepFunction.executeFunctionOutput.grantInvoke(
+      submiJobIntegration.functionOutput
+    );
+
+    //######  ADMISSION CONTROL #########
+    // Async jobs are queued by priority and started while executions are under the cap.
+    // The invocations themselves are capped by the reserved concurrency of ffmpeg-execute
+    const jobScheduler = new JobScheduler(this, "JobScheduler", {
+      stateMachine: stepFunction.stepFunctionOutput,
+      maxConcurrentExecutions: maxFfmpegInvocations,
+    });
+    jobScheduler.interactiveQueue.grantSendMessages(submiJobIntegration.functionOutput);
+    submiJobIntegration.functionOutput.addEnvironment("JOB_QUEUE_URL", jobScheduler.interactiveQueue.queueUrl);
+    // Batch submissions are dispatched after the single API jobs
+    jobScheduler.bulkQueue.grantSendMessages(submiJobIntegration.functionOutput);
+    submiJobIntegration.functionOutput.addEnvironment("BULK_QUEUE_URL", jobScheduler.bulkQueue.queueUrl);
+
+    //######  JOB STATUS TABLE AND QUERY API #########
+    // Lifecycle of each job written by the submission and ffmpeg-execute functions
+    const jobStatusApi = new JobStatusApi(this, "JobStatusApi", {
+      apiGW: apiGW.apiLambda,
+      apiGWPath: "jobs",
+      apiAuthorizer: apiGW.authorizerToken,
+      writers: [
+        submiJobIntegration.functionOutput,
+        stepFunction.executeFunctionOutput,
+      ],
+    });
 
     /*
     //######  S3 EVENT LAMBDA FUNCTION #########
@@ -109,9 +146,17 @@ export class CdkFFMpegLambdaStack extends cdk.Stack {
           CLOUDFRONT_HOSTNAME: "https://"+S3BucketCloudFront.cloudFrontOutput.domainName,
           BUCKET_NAME: S3BucketCloudFront.s3BucketOutput.bucketName,
           STEP_FUNCTION_ARN: stepFunction.stepFunctionOutput.stateMachineArn,
+          MAX_PARALLEL_STARTS: "10",
         },
         timeout: cdk.Duration.seconds(60),
         memorySize: 512,
+        // Bulk ingest: read the S3 events from a queue in batches
+        queueBuffered: true,
+        batchSize: 100,
+        maxBatchingWindow: cdk.Duration.seconds(20),
+        // Skip duplicate deliveries and re-uploads of the same content
+        dedupeLedger: true,
+        ledgerTtl: cdk.Duration.days(7),
       }
     );
 
@@ -119,6 +164,12 @@ export class CdkFFMpegLambdaStack extends cdk.Stack {
     stepFunction.stepFunctionOutput.grantStartExecution(
       s3EventLambda.lambdaFunction
     );
+    // S3 event jobs are dispatched after the API jobs
+    jobScheduler.bulkQueue.grantSendMessages(s3EventLambda.lambdaFunction);
+    s3EventLambda.lambdaFunction.addEnvironment("JOB_QUEUE_URL", jobScheduler.bulkQueue.queueUrl);
+    // Record the submitted jobs in the job status table
+    jobStatusApi.table.grantReadWriteData(s3EventLambda.lambdaFunction);
+    s3EventLambda.lambdaFunction.addEnvironment("JOBS_TABLE", jobStatusApi.table.tableName);
     */
 
   }
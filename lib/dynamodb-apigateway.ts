@@ -4,11 +4,22 @@ import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
 import * as iam from "aws-cdk-lib/aws-iam";
 import { Construct } from "constructs";
 
+export interface ApiGatewayDynamoDbIndex {
+  indexName: string;
+  partitionKey: string;
+  // Numeric sort key, queries return the highest values first
+  sortKey?: string;
+}
+
 export interface ApiGatewayDynamoDbProps {
   apiGW: apigateway.RestApi;
   apiGWPath: string;
   tableName: string;
   partitionKey: string;
+  billingMode?: dynamodb.BillingMode;
+  // Each index is queried with GET {apiGWPath}/{indexName}/{value}
+  globalIndexes?: ApiGatewayDynamoDbIndex[];
+  apiAuthorizer?: apigateway.IAuthorizer;
 }
 
 export class ApiGatewayDynamoDb extends Construct {
@@ -24,11 +35,24 @@ export class ApiGatewayDynamoDb extends Construct {
         name: props.partitionKey,
         type: dynamodb.AttributeType.STRING,
       },
-      billingMode: dynamodb.BillingMode.PROVISIONED,
+      billingMode: props.billingMode || dynamodb.BillingMode.PROVISIONED,
       removalPolicy: cdk.RemovalPolicy.DESTROY, // Use with caution in production
       timeToLiveAttribute: "TTL",  // Add this line to enable TTL
     });
 
+    for (const index of props.globalIndexes || []) {
+      this.table.addGlobalSecondaryIndex({
+        indexName: index.indexName,
+        partitionKey: {
+          name: index.partitionKey,
+          type: dynamodb.AttributeType.STRING,
+        },
+        sortKey: index.sortKey
+          ? { name: index.sortKey, type: dynamodb.AttributeType.NUMBER }
+          : undefined,
+      });
+    }
+
     // Create IAM role for API Gateway to access DynamoDB
     const role = new iam.Role(this, "ApiGatewayDynamoDBRole", {
       assumedBy: new iam.ServicePrincipal("apigateway.amazonaws.com"),
@@ -69,6 +93,7 @@ items.addMethod(
       },
     }),
     {
+      authorizer: props.apiAuthorizer,
       methodResponses: [
         {
           statusCode: "200",
@@ -148,6 +173,61 @@ items.addMethod(
           },
         }),
         {
+          authorizer: props.apiAuthorizer,
+          methodResponses: [
+            {
+              statusCode: "200",
+              responseParameters: {
+                "method.response.header.Access-Control-Allow-Origin": true,
+                "method.response.header.Access-Control-Allow-Headers": true,
+                "method.response.header.Access-Control-Allow-Methods": true,
+              },
+            },
+          ],
+        }
+      );
+
+
+    // GET {indexName}/{value} (Query on a global secondary index)
+    for (const index of props.globalIndexes || []) {
+      const indexItems = items.addResource(index.indexName).addResource("{value}");
+      indexItems.addMethod(
+        "GET",
+        new apigateway.AwsIntegration({
+          service: "dynamodb",
+          action: "Query",
+          options: {
+            credentialsRole: role,
+            integrationResponses: [
+              {
+                statusCode: "200",
+                responseTemplates: {
+                  "application/json": "",
+                },
+                responseParameters: {
+                  "method.response.header.Access-Control-Allow-Origin": "'*'",
+                  "method.response.header.Access-Control-Allow-Headers": "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'",
+                  "method.response.header.Access-Control-Allow-Methods": "'GET,OPTIONS'",
+                },
+              },
+            ],
+            requestTemplates: {
+              "application/json": JSON.stringify({
+                TableName: this.table.tableName,
+                IndexName: index.indexName,
+                KeyConditionExpression: "#pk = :value",
+                ExpressionAttributeNames: { "#pk": index.partitionKey },
+                ExpressionAttributeValues: {
+                  ":value": { S: "$method.request.path.value" },
+                },
+                ScanIndexForward: false,
+                Limit: 100,
+              }),
+            },
+          },
+        }),
+        {
+          authorizer: props.apiAuthorizer,
           methodResponses: [
             {
               statusCode: "200",
@@ -160,7 +240,7 @@ items.addMethod(
           ],
         }
       );
-      
+    }
 
     new cdk.CfnOutput(this, `ApiURL${props.apiGWPath}`, {
       value: `${props.apiGW.url}${props.apiGWPath}`,
@@ -0,0 +1,69 @@
+import { join } from "path";
+import { Construct } from "constructs";
+import * as cdk from "aws-cdk-lib";
+import * as lambda from "aws-cdk-lib/aws-lambda";
+import * as sqs from "aws-cdk-lib/aws-sqs";
+import * as sfn from "aws-cdk-lib/aws-stepfunctions";
+import * as events from "aws-cdk-lib/aws-events";
+import * as targets from "aws-cdk-lib/aws-events-targets";
+
+//Construct to queue the jobs by priority and start them under a concurrency cap
+interface JobSchedulerConstructProps {
+  readonly stateMachine: sfn.StateMachine;
+  // Executions of the state machine running at the same time
+  readonly maxConcurrentExecutions: number;
+}
+
+export class JobScheduler extends Construct {
+  public readonly interactiveQueue: sqs.Queue;
+  public readonly bulkQueue: sqs.Queue;
+
+  constructor(scope: Construct, id: string, props: JobSchedulerConstructProps) {
+    super(scope, id);
+
+    // A job that cannot be started after 5 attempts goes to the dead-letter queue
+    const deadLetterQueue = new sqs.Queue(this, "JobDeadLetterQueue", {
+      retentionPeriod: cdk.Duration.days(14),
+    });
+    const queueProps = {
+      visibilityTimeout: cdk.Duration.seconds(60),
+      retentionPeriod: cdk.Duration.days(4),
+      deadLetterQueue: {
+        queue: deadLetterQueue,
+        maxReceiveCount: 5,
+      },
+    };
+    // API jobs are dispatched before the S3 event jobs
+    this.interactiveQueue = new sqs.Queue(this, "InteractiveJobQueue", queueProps);
+    this.bulkQueue = new sqs.Queue(this, "BulkJobQueue", queueProps);
+
+    const dispatcherFunction = new lambda.Function(this, "DispatcherFunction", {
+      memorySize: 256,
+      timeout: cdk.Duration.seconds(70),
+      description: "Function to start queued ffmpeg jobs under the concurrency cap",
+      functionName: "ffmpeg-dispatcher",
+      runtime: lambda.Runtime.PYTHON_3_9,
+      handler: "index.lambda_handler",
+      code: lambda.Code.fromAsset(join(__dirname, "lambda", "ffmpeg-dispatcher")),
+      // A single dispatcher counts the running executions
+      reservedConcurrentExecutions: 1,
+      environment: {
+        STATE_MACHINE_ARN: props.stateMachine.stateMachineArn,
+        INTERACTIVE_QUEUE_URL: this.interactiveQueue.queueUrl,
+        BULK_QUEUE_URL: this.bulkQueue.queueUrl,
+        MAX_CONCURRENT_EXECUTIONS: String(props.maxConcurrentExecutions),
+      },
+    });
+
+    this.interactiveQueue.grantConsumeMessages(dispatcherFunction);
+    this.bulkQueue.grantConsumeMessages(dispatcherFunction);
+    props.stateMachine.grantStartExecution(dispatcherFunction);
+    props.stateMachine.grantRead(dispatcherFunction);
+
+    // Runs every minute and polls the queues until the next run
+    new events.Rule(this, "DispatcherSchedule", {
+      schedule: events.Schedule.rate(cdk.Duration.minutes(1)),
+      targets: [new targets.LambdaFunction(dispatcherFunction)],
+    });
+  }
+}
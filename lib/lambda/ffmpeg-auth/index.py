@@ -1,34 +1,96 @@
-# A simple token-based authorizer example to demonstrate how to use an authorization token
-# to allow or deny a request. In this example, the caller named 'user' is allowed to invoke
-# a request if the client-supplied token value is 'allow'. The caller is not allowed to invoke
-# the request if the token value is 'deny'. If the token value is 'unauthorized' or an empty
-# string, the authorizer function returns an HTTP 401 status code. For any other token value,
-# the authorizer returns an HTTP 500 status code.
+# Token-based authorizer backed by a store of hashed API keys.
+# The token sent in the authorization header is hashed (SHA-256) and looked up in the
+# API_KEYS_TABLE DynamoDB table, the token itself is never stored. Each key item carries
+# the tenant and its settings (priority, quota), returned to API Gateway as context.
+# Unknown tokens get a 401, disabled or expired keys an explicit Deny.
+# The policy covers every method of the stage, so API Gateway can reuse the cached
+# decision (resultsCacheTtl) for all the calls made with the same token.
 # Note that token values are case-sensitive.
 
-import json
+import time
+import hashlib
+import os
+from collections import OrderedDict
+import boto3
+from botocore.config import Config
+
+API_KEYS_TABLE = os.environ.get('API_KEYS_TABLE')
+# In-memory cache of the key lookups, per container: known keys / unknown tokens
+KEY_CACHE_TTL = int(os.environ.get('KEY_CACHE_TTL', 300))
+UNKNOWN_KEY_CACHE_TTL = 30
+# Entries kept per container: random tokens cannot grow the memory beyond this
+KEY_CACHE_MAX_ENTRIES = int(os.environ.get('KEY_CACHE_MAX_ENTRIES', 10000))
+
+dynamodb = boto3.client('dynamodb', config=Config(
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=2
+))
+
+# key hash => (expiry of the cache entry, key item or None), least recently used first
+key_cache = OrderedDict()
+
+
+def lookup_key(key_hash):
+    # Function to read the key item, from the in-memory cache when possible
+    now = time.time()
+    cached = key_cache.get(key_hash)
+    if cached and cached[0] > now:
+        key_cache.move_to_end(key_hash)
+        return cached[1]
+    response = dynamodb.get_item(TableName=API_KEYS_TABLE, Key={'key_hash': {'S': key_hash}})
+    item = response.get('Item')
+    key_cache.pop(key_hash, None)
+    key_cache[key_hash] = (now + (KEY_CACHE_TTL if item else UNKNOWN_KEY_CACHE_TTL), item)
+    # Drop the expired entries, then the least recently used ones over the limit
+    for cached_hash in [cached_hash for cached_hash, (expires_at, _) in key_cache.items() if expires_at <= now]:
+        del key_cache[cached_hash]
+    while len(key_cache) > KEY_CACHE_MAX_ENTRIES:
+        key_cache.popitem(last=False)
+    return item
+
+
+def stage_resource(method_arn):
+    # arn:aws:execute-api:region:account:api_id/stage/METHOD/path => arn:...:api_id/stage/*
+    arn_prefix, _, path = method_arn.partition('/')
+    stage = path.split('/')[0]
+    return f"{arn_prefix}/{stage}/*"
+
+
+def key_context(item):
+    # Authorizer context values can only be strings, numbers or booleans
+    return {
+        'tenant': item.get('tenant', {}).get('S', ''),
+        'priority': item.get('priority', {}).get('S', 'interactive'),
+        'quota': int(item.get('quota', {}).get('N', 0))
+    }
 
 
 def lambda_handler(event, context):
-    token = event['authorizationToken']
-    if token == 'M5n09Kul8jXd':
-        print('authorized')
-        response = generatePolicy('user', 'Allow', event['methodArn'])
-    elif token == 'deny':
-        print('unauthorized')
-        response = generatePolicy('user', 'Deny', event['methodArn'])
-    elif token == 'unauthorized':
-        print('unauthorized')
+    token = event.get('authorizationToken') or ''
+    if not token:
+        raise Exception('Unauthorized')  # Return a 401 Unauthorized response
+
+    key_hash = hashlib.sha256(token.encode()).hexdigest()
+    item = lookup_key(key_hash)
+    if item is None:
+        print('unauthorized: unknown key')
         raise Exception('Unauthorized')  # Return a 401 Unauthorized response
-        return 'unauthorized'
-    try:
-        return json.loads(response)
-    except BaseException:
-        print('unauthorized')
-        return 'unauthorized'  # Return a 500 error
 
+    resource = stage_resource(event['methodArn'])
+    tenant_context = key_context(item)
+    expires_at = int(item.get('expires_at', {}).get('N', 0))
+    enabled = item.get('enabled', {}).get('BOOL', True)
+    if not enabled or (expires_at and expires_at < time.time()):
+        print(f"unauthorized: key of {tenant_context['tenant']} disabled or expired")
+        return generatePolicy(tenant_context['tenant'], 'Deny', resource, tenant_context)
 
-def generatePolicy(principalId, effect, resource):
+    print(f"authorized: {tenant_context['tenant']}")
+    return generatePolicy(tenant_context['tenant'], 'Allow', resource, tenant_context)
+
+
+def generatePolicy(principalId, effect, resource, context):
     authResponse = {}
     authResponse['principalId'] = principalId
     if (effect and resource):
@@ -41,10 +103,5 @@ def generatePolicy(principalId, effect, resource):
         statementOne['Resource'] = resource
         policyDocument['Statement'] = [statementOne]
         authResponse['policyDocument'] = policyDocument
-    authResponse['context'] = {
-        "stringKey": "stringval",
-        "numberKey": 123,
-        "booleanKey": True
-    }
-    authResponse_JSON = json.dumps(authResponse)
-    return authResponse_JSON
\ No newline at end of file
+    authResponse['context'] = context
+    return authResponse
@@ -0,0 +1,128 @@
+import time
+import json
+import boto3
+import os
+from botocore.config import Config
+
+# Queues read in this order: interactive API jobs always go before bulk S3 jobs
+PRIORITY_QUEUES = [
+    ('interactive', os.environ.get('INTERACTIVE_QUEUE_URL')),
+    ('bulk', os.environ.get('BULK_QUEUE_URL'))
+]
+# Executions counted against the cap, and started for the queued jobs that do not name their state machine
+STATE_MACHINE_ARN = os.environ.get('STATE_MACHINE_ARN')
+# Executions of the state machine allowed to run at the same time
+MAX_CONCURRENT_EXECUTIONS = int(os.environ.get('MAX_CONCURRENT_EXECUTIONS', 50))
+POLL_INTERVAL = 2
+# Stop polling this long before the Lambda timeout, the next scheduled run takes over
+STOP_MARGIN_MS = 10000
+METRICS_NAMESPACE = "FFmpegRestAPI"
+
+client_config = Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+stepfunctions = boto3.client('stepfunctions', config=client_config)
+sqs = boto3.client('sqs', config=client_config)
+
+def emit_metrics(metrics, dimensions=None):
+    # Function to print the metrics in CloudWatch Embedded Metric Format
+    dimensions = dimensions or {}
+    units = {name: 'Milliseconds' if name.endswith('Time') else 'Count' for name in metrics}
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in metrics]
+            }]
+        },
+        **dimensions,
+        **metrics
+    }))
+
+def count_running(limit):
+    # Function to count the running executions, counting stops at limit
+    running = 0
+    paginator = stepfunctions.get_paginator('list_executions')
+    for page in paginator.paginate(stateMachineArn=STATE_MACHINE_ARN, statusFilter='RUNNING', PaginationConfig={'PageSize': 1000}):
+        running += len(page['executions'])
+        if running >= limit:
+            break
+    return running
+
+def queue_depth(queue_url):
+    attributes = sqs.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages']
+    )['Attributes']
+    return int(attributes['ApproximateNumberOfMessages'])
+
+def receive_jobs(queue_url, count):
+    # Function to read up to count messages of a queue, oldest first
+    messages = []
+    while len(messages) < count:
+        response = sqs.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=min(count - len(messages), 10),
+            AttributeNames=['SentTimestamp']
+        )
+        if not response.get('Messages'):
+            break
+        messages += response['Messages']
+    return sorted(messages, key=lambda message: int(message['Attributes']['SentTimestamp']))
+
+def start_job(message):
+    # Function to start the execution of a queued job, True when the message can be deleted
+    job = json.loads(message['Body'])
+    try:
+        stepfunctions.start_execution(
+            # State machine and execution name were chosen at submission: the executionArn was already returned
+            stateMachineArn=job.get('stateMachineArn', STATE_MACHINE_ARN),
+            name=job['name'],
+            input=json.dumps(job['input'])
+        )
+        return True
+    except stepfunctions.exceptions.ExecutionAlreadyExists:
+        # Message delivered twice: the job is already running
+        return True
+    except Exception as e:
+        # Left in the queue: it comes back after the visibility timeout
+        print(f"Error starting job {job.get('name')}: {str(e)}")
+        return False
+
+def dispatch():
+    # Function to start queued jobs while the running executions are under the cap
+    running = count_running(MAX_CONCURRENT_EXECUTIONS)
+    free = MAX_CONCURRENT_EXECUTIONS - running
+    started = 0
+    for priority, queue_url in PRIORITY_QUEUES:
+        if not queue_url:
+            continue
+        depth = queue_depth(queue_url)
+        wait_times = []
+        if free > 0 and depth:
+            for message in receive_jobs(queue_url, free):
+                if start_job(message):
+                    sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+                    wait_times.append(time.time() * 1000 - int(message['Attributes']['SentTimestamp']))
+                    free -= 1
+                    started += 1
+        metrics = {'QueueDepth': depth, 'JobsDispatched': len(wait_times)}
+        if wait_times:
+            metrics['QueueWaitTime'] = max(wait_times)
+        emit_metrics(metrics, {'Priority': priority})
+    emit_metrics({'RunningExecutions': running + started})
+    return started
+
+def lambda_handler(event, context):
+    # Scheduled every minute (one instance at a time): polls the queues until the next run
+    started = 0
+    while context.get_remaining_time_in_millis() > STOP_MARGIN_MS:
+        started += dispatch()
+        time.sleep(POLL_INTERVAL)
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'jobs_started': started})
+    }
@@ -1,16 +1,285 @@
+import time
+# Startup profile: time spent in imports and client creation on a cold start
+INIT_START = time.perf_counter()
+import hashlib
 import json
+import mimetypes
 import os
+import re
+import resource
 import boto3
+import shlex
 import subprocess
+import threading
 import urllib.request
 import uuid
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 from urllib.parse import urlparse
+from videotools_functions import AnalysisCache, ProbeError, VideoAnalyzer, Workspace
+INIT_IMPORTS = time.perf_counter()
 
-def execute_ffmpeg(cmd, context):
+# Containers with their index (moov / cues) at the end of the file: ffmpeg has to seek to read them
+SEEKABLE_CONTAINERS = ('.mp4', '.mov', '.m4v', '.m4a', '.3gp', '.mkv', '.webm')
+# HTTP options so a streamed input survives a dropped connection
+STREAM_INPUT_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+PRESIGNED_URL_EXPIRY = 3600
+# Demuxers that can be used as-is by the second stage, anything else is remuxed to MP4
+MP4_FORMATS = ('mov', 'mp4', 'm4a', '3gp')
+# Start offset (in seconds) above which the timestamps are considered broken
+MAX_START_TIME = 1.0
+# Streaming output: size of each multipart part and number of parts uploading at the same time
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_MAX_IN_FLIGHT = 4
+# Muxers writing to a pipe (no seeking back), by extension of the streamed output
+STREAM_MUXERS = {
+    '.mp4': '-f mp4 -movflags frag_keyframe+empty_moov',
+    '.m4v': '-f mp4 -movflags frag_keyframe+empty_moov',
+    '.mov': '-f mp4 -movflags frag_keyframe+empty_moov',
+    '.ts': '-f mpegts'
+}
+# Directory output (HLS/DASH packaging): manifests are uploaded once every segment is in S3
+MANIFEST_EXTENSIONS = ('.m3u8', '.mpd')
+DIRECTORY_UPLOAD_WORKERS = 8
+DIRECTORY_POLL_INTERVAL = 1.0
+# HLS segments are complete once listed in a playlist, other segments when they have not changed for this long
+SEGMENT_SETTLE_TIME = 2.0
+# URI attributes of playlist tags (EXT-X-MAP init segment, EXT-X-MEDIA...)
+HLS_URI_PATTERN = re.compile(r'URI="([^"]+)"')
+PACKAGING_FORMAT_PATTERN = re.compile(r"-f\s+(hls|dash)\b")
+
+# Chunked mode: default target duration of a chunk (seconds), cut at the next keyframe
+DEFAULT_CHUNK_DURATION = 60
+CONCAT_PROTOCOLS = "file,http,https,tcp,tls,crypto"
+
+# Progress channel: ffmpeg writes a sample every PROGRESS_PERIOD seconds, at most MAX_PROGRESS_SAMPLES are kept
+PROGRESS_PERIOD = 2
+MAX_PROGRESS_SAMPLES = 300
+METRICS_NAMESPACE = "FFmpegRestAPI"
+# Deadline: seconds kept before the Lambda timeout to upload the encoded prefix (checkpoint)
+DEFAULT_CHECKPOINT_MARGIN = 60
+# Result cache: records are stored in the bucket, outputs expire with the 7 days lifecycle rule
+CACHE_PREFIX = "cache"
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', 6 * 24 * 3600))
+# Analysis cache: VideoAnalyzer results by input ETag, kept in the container (LRU) and under cache/analysis
+ANALYSIS_CACHE_TTL_SECONDS = int(os.environ.get('ANALYSIS_CACHE_TTL_SECONDS', CACHE_TTL_SECONDS))
+ANALYSIS_CACHE_ENTRIES = int(os.environ.get('ANALYSIS_CACHE_ENTRIES', 16))
+ANALYSIS_CACHE_MEMORY_MB = int(os.environ.get('ANALYSIS_CACHE_MEMORY_MB', 64))
+ANALYSIS_CACHE_MAX_OBJECT_MB = int(os.environ.get('ANALYSIS_CACHE_MAX_OBJECT_MB', 100))
+
+# ABR ladder: segment duration (seconds), keyframes are forced on segment boundaries in every rendition
+LADDER_SEGMENT_DURATION = 6
+DEFAULT_LADDER_CODEC = "libx264"
+DEFAULT_LADDER_PRESET = "veryfast"
+DEFAULT_LADDER_AUDIO_BITRATE = "128k"
+
+# Adaptive preset (preset "auto"): sources meeting the target spec are copied, the others re-encoded
+TARGET_VIDEO_CODECS = ('h264',)
+TARGET_PROFILES = ('Constrained Baseline', 'Baseline', 'Main', 'High')
+TARGET_PIX_FMTS = ('yuv420p', 'yuvj420p')
+TARGET_MAX_HEIGHT = 1080
+TARGET_MAX_VIDEO_BITRATE = 8000000
+TARGET_AUDIO_CODECS = ('aac',)
+# Below this many bits per pixel the source is heavily compressed: banding and blocking to clean up
+LOW_BITS_PER_PIXEL = 0.05
+# Only the first video and audio streams go to the MP4 output (subtitle and data streams are dropped)
+PRESET_MAPS = "-map 0:v:0 -map 0:a:0?"
+PRESET_AUDIO = "-c:a aac -b:a 128k"
+
+# Job status table: lifecycle of the jobs submitted with a job_id, kept as long as the outputs
+JOBS_TABLE = os.environ.get('JOBS_TABLE')
+JOBS_TTL_SECONDS = 7 * 24 * 3600
+
+ffmpeg_version = None
+cpu_count = None
+
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('application/dash+xml', '.mpd')
+mimetypes.add_type('video/mp2t', '.ts')
+mimetypes.add_type('video/iso.segment', '.m4s')
+
+# Clients are created once per container and reused by warm invocations (connection pool included)
+# The pool is sized for the parallel multipart and directory uploads
+s3_client = boto3.client('s3', config=Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    max_pool_connections=DIRECTORY_UPLOAD_WORKERS + MULTIPART_MAX_IN_FLIGHT
+))
+jobs_table = boto3.resource('dynamodb', config=Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)).Table(JOBS_TABLE) if JOBS_TABLE else None
+# Its in-process tier lives as long as the container
+analysis_cache = AnalysisCache(
+    s3_client, os.environ.get('BUCKET_NAME'), f"{CACHE_PREFIX}/analysis",
+    ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS,
+    max_entries=ANALYSIS_CACHE_ENTRIES,
+    max_memory_bytes=ANALYSIS_CACHE_MEMORY_MB * 1024 * 1024,
+    max_object_bytes=ANALYSIS_CACHE_MAX_OBJECT_MB * 1024 * 1024
+)
+INIT_END = time.perf_counter()
+print(f"Init: imports {INIT_IMPORTS - INIT_START:.3f}s, clients {INIT_END - INIT_IMPORTS:.3f}s")
+
+class FFmpegProgress:
+    # Class to read the machine readable -progress channel of ffmpeg from a pipe
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.samples = []
+        self.started = None
+        self.thread = threading.Thread(target=self.read)
+
+    def args(self):
+        return f"-progress pipe:{self.write_fd} -stats_period {PROGRESS_PERIOD}"
+
+    def start(self):
+        self.started = time.time()
+        self.thread.start()
+
+    def finish(self):
+        # ffmpeg has exited: closing our copy of the write end ends the reader
+        os.close(self.write_fd)
+        self.thread.join()
+
+    def read(self):
+        current = {}
+        with os.fdopen(self.read_fd) as progress_pipe:
+            for line in progress_pipe:
+                key, _, value = line.strip().partition('=')
+                current[key] = value
+                # Each block of key=value lines ends with progress=continue|end
+                if key == 'progress':
+                    self.add_sample(current)
+                    current = {}
+
+    def add_sample(self, values):
+        out_time_us = to_number(values.get('out_time_us'), int)
+        sample = {
+            'frame': to_number(values.get('frame'), int),
+            'fps': to_number(values.get('fps')),
+            'speed': to_number(values.get('speed', '').rstrip('x')),
+            'bitrate_kbps': to_number(values.get('bitrate', '').replace('kbits/s', '')),
+            'out_time': round(out_time_us / 1000000, 3) if out_time_us is not None else None,
+            'total_size': to_number(values.get('total_size'), int),
+            'elapsed': round(time.time() - self.started, 3)
+        }
+        self.samples.append(sample)
+        if len(self.samples) > MAX_PROGRESS_SAMPLES:
+            # Keep the whole encode covered with half the resolution
+            self.samples = self.samples[::2]
+
+    def latest(self, field):
+        # Last known value, the final block can report N/A
+        for sample in reversed(self.samples):
+            if sample[field] is not None:
+                return sample[field]
+        return None
+
+    def summary(self, with_samples=True):
+        summary = {field: self.latest(field) for field in ('frame', 'fps', 'speed', 'bitrate_kbps', 'out_time', 'total_size')}
+        if with_samples:
+            summary['samples'] = self.samples
+        return summary
+
+def to_number(value, cast=float):
+    # ffmpeg reports N/A when a value is not known yet
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+def emit_metrics(context, metrics):
+    # Function to print the metrics in CloudWatch Embedded Metric Format
+    units = {name: 'Milliseconds' if name.endswith('Time') else 'None' for name in metrics}
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in metrics]
+            }]
+        },
+        'FunctionName': getattr(context, 'function_name', 'ffmpeg-execute'),
+        **metrics
+    }))
+
+class JobStatus:
+    # Class to write the lifecycle of a job in the jobs table:
+    # submitted, downloading, encoding, uploading, done or failed
+
+    def __init__(self, job):
+        self.job_id = job.get('job_id')
+        self.video_id = job.get('video_id', '')
+
+    def update(self, status, **fields):
+        # The job is never failed because its status could not be written
+        if jobs_table is None or not self.job_id:
+            return
+        now = int(time.time())
+        values = {'status': status, 'updated_at': now, 'TTL': now + JOBS_TTL_SECONDS, **fields}
+        if self.video_id:
+            # Key of the video_id index: cannot be an empty string
+            values['video_id'] = self.video_id
+        # DynamoDB stores numbers as Decimal
+        values = json.loads(json.dumps(values), parse_float=Decimal)
+        names = {f"#f{index}": field for index, field in enumerate(values)}
+        attribute_values = {f":v{index}": value for index, value in enumerate(values.values())}
+        attribute_values[':now'] = now
+        try:
+            jobs_table.update_item(
+                Key={'job_id': self.job_id},
+                UpdateExpression='SET ' + ', '.join(f"#f{index} = :v{index}" for index in range(len(values)))
+                    + ', created_at = if_not_exists(created_at, :now)',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=attribute_values
+            )
+        except Exception as e:
+            print(f"Error writing status {status} of job {self.job_id}: {e}")
+
+    def finish(self, result):
+        # Terminal state from the result returned to the Step Function
+        body = result.get('body')
+        if result.get('statusCode') == 202:
+            self.update('encoding', checkpoints=len(body['checkpoint']['parts']))
+        elif result.get('statusCode') == 200:
+            progress = body.get('progress') or {}
+            self.update(
+                'done',
+                output_files=body.get('output_files'),
+                timings=body.get('timings'),
+                output_size=body.get('output_size'),
+                fps=progress.get('fps'),
+                speed=progress.get('speed'),
+                cache_hit=(body.get('cache') or {}).get('hit', False)
+            )
+        else:
+            self.update('failed', error=str(body)[:1000])
+
+def execute_ffmpeg(cmd, context, progress=None, deadline=None):
     # Function Execute ffmpeg command
-    full_cmd = f"ffmpeg -y {cmd}"
+    full_cmd = f"ffmpeg -y {progress.args() + ' ' if progress else ''}{cmd}"
     print(f"Executing: {full_cmd}")
-    result = subprocess.run(full_cmd, shell=True, capture_output=True, text=True)
+    pass_fds = (progress.write_fd,) if progress else ()
+    if progress:
+        progress.start()
+    try:
+        if deadline:
+            # ffmpeg is stopped with 'q' on its stdin when the deadline is near
+            stdin_read, stdin_write = os.pipe()
+            process = subprocess.Popen(full_cmd, shell=True, stdin=stdin_read, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, text=True, pass_fds=pass_fds)
+            os.close(stdin_read)
+            deadline.watch(process, progress, stdin_write)
+            stdout, stderr = process.communicate()
+            deadline.finish()
+            result = subprocess.CompletedProcess(full_cmd, process.returncode, stdout, stderr)
+        else:
+            result = subprocess.run(full_cmd, shell=True, capture_output=True, text=True, pass_fds=pass_fds)
+    finally:
+        if progress:
+            progress.finish()
     
     print(f"FFmpeg return code: {result.returncode}")
     print(f"FFmpeg stdout: {result.stdout}")
@@ -24,23 +293,876 @@ def execute_ffmpeg(cmd, context):
         }
     return result.stdout
 
+class DeadlineMonitor:
+    # Class to stop ffmpeg cleanly when the encode cannot finish before the Lambda timeout
+
+    def __init__(self, context, total_duration, offset=0, margin=DEFAULT_CHECKPOINT_MARGIN):
+        self.context = context
+        self.total_duration = total_duration
+        # Position in the input where this invocation started
+        self.offset = offset
+        self.margin = margin
+        self.stopped = False
+        self.estimated_remaining = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def time_left(self):
+        return self.context.get_remaining_time_in_millis() / 1000 - self.margin
+
+    def estimate(self, progress):
+        # Wall-clock seconds needed to encode the rest of the input at the current speed
+        out_time = progress.latest('out_time') if progress else None
+        speed = progress.latest('speed') if progress else None
+        if out_time is None or not speed:
+            return None
+        return (self.total_duration - self.offset - out_time) / speed
+
+    def should_stop(self, progress):
+        time_left = self.time_left()
+        # Only stop at the last moment: what is encoded until then is kept
+        if time_left > 2 * PROGRESS_PERIOD:
+            return False
+        self.estimated_remaining = self.estimate(progress)
+        return self.estimated_remaining is None or self.estimated_remaining > time_left
+
+    def watch(self, process, progress, stdin_write):
+        def run():
+            with os.fdopen(stdin_write, 'wb', buffering=0) as ffmpeg_stdin:
+                while not self.stop_event.wait(1):
+                    if process.poll() is None and self.should_stop(progress):
+                        print(f"Deadline near, stopping ffmpeg (estimated remaining: {self.estimated_remaining}s)")
+                        self.stopped = True
+                        ffmpeg_stdin.write(b'q')
+                        return
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+
+    def finish(self):
+        self.stop_event.set()
+        self.thread.join()
+
+def execute_ffmpeg_to_s3(cmd, s3_client, bucket_name, s3_key, context, progress=None):
+    # Function Execute ffmpeg command writing to pipe:1, stdout is pushed to a S3 multipart upload
+    full_cmd = f"ffmpeg -y {progress.args() + ' ' if progress else ''}{cmd}"
+    print(f"Executing: {full_cmd}")
+    content_type = mimetypes.guess_type(s3_key)[0] or 'application/octet-stream'
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket_name, Key=s3_key, ContentType=content_type
+    )['UploadId']
+    if progress:
+        progress.start()
+    try:
+        process = subprocess.Popen(full_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   pass_fds=(progress.write_fd,) if progress else ())
+    except Exception:
+        if progress:
+            progress.finish()
+        raise
+
+    # Drain stderr in the background so ffmpeg never blocks on it
+    stderr_output = []
+    stderr_thread = threading.Thread(target=lambda: stderr_output.append(process.stderr.read().decode(errors='replace')))
+    stderr_thread.start()
+
+    # Bound the parts held in memory while they are uploading
+    slots = threading.BoundedSemaphore(MULTIPART_MAX_IN_FLIGHT)
+
+    def upload_part(part_number, data):
+        try:
+            response = s3_client.upload_part(
+                Bucket=bucket_name, Key=s3_key, UploadId=upload_id,
+                PartNumber=part_number, Body=data
+            )
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            slots.release()
+
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=MULTIPART_MAX_IN_FLIGHT) as executor:
+            part_number = 1
+            while True:
+                data = process.stdout.read(MULTIPART_PART_SIZE)
+                # An empty output still needs one part to complete the upload
+                if not data and part_number > 1:
+                    break
+                slots.acquire()
+                futures.append(executor.submit(upload_part, part_number, data))
+                part_number += 1
+                if not data:
+                    break
+            parts = [future.result() for future in futures]
+        returncode = process.wait()
+    except Exception as e:
+        process.kill()
+        process.wait()
+        stderr_thread.join()
+        if progress:
+            progress.finish()
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+        return {
+            'statusCode': 500,
+            'body': f'Upload error: {str(e)}'
+        }
+    stderr_thread.join()
+    if progress:
+        progress.finish()
+    stderr = stderr_output[0] if stderr_output else ''
+
+    print(f"FFmpeg return code: {returncode}")
+    if stderr:
+        print(f"FFmpeg stderr: {stderr}")
+
+    if returncode != 0:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+        return {
+            'statusCode': 500,
+            'body': f'FFmpeg error: {stderr}'
+        }
+    s3_client.complete_multipart_upload(
+        Bucket=bucket_name, Key=s3_key, UploadId=upload_id,
+        MultipartUpload={'Parts': parts}
+    )
+    print(f"Streamed {len(parts)} parts to s3://{bucket_name}/{s3_key}")
+    return ''
+
+class DirectoryUploader:
+    # Class to upload the files ffmpeg writes in the session folder while it is still encoding
+
+    def __init__(self, s3_client, folder, bucket_name, s3_prefix):
+        self.s3_client = s3_client
+        self.folder = folder
+        self.bucket_name = bucket_name
+        self.s3_prefix = s3_prefix
+        self.executor = ThreadPoolExecutor(max_workers=DIRECTORY_UPLOAD_WORKERS)
+        self.futures = {}
+        self.sizes = {}
+        # Size and mtime of each file when it was submitted, to catch the ones written again afterwards
+        self.submitted = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.watch)
+        # Files left by a previous job in the same folder are not part of this output
+        self.existing = {path: os.path.getmtime(path) for path in self.list_files()}
+
+    def list_files(self):
+        files = []
+        for root, dirs, names in os.walk(self.folder):
+            for name in names:
+                files.append(os.path.join(root, name))
+        return files
+
+    def s3_key(self, path):
+        return f"{self.s3_prefix}/{os.path.relpath(path, self.folder)}"
+
+    def upload(self, path):
+        s3_key = self.s3_key(path)
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.s3_client.upload_file(path, self.bucket_name, s3_key, ExtraArgs={'ContentType': content_type})
+        return s3_key
+
+    def submit(self, path):
+        stat = os.stat(path)
+        self.submitted[path] = (stat.st_size, stat.st_mtime)
+        self.futures[path] = self.executor.submit(self.upload, path)
+
+    def changed_since_submit(self):
+        # Function to list the uploaded files that ffmpeg wrote again after their upload was submitted
+        changed = []
+        for path, (size, mtime) in self.submitted.items():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                changed.append(path)
+        return changed
+
+    def playlist_references(self):
+        # Function to list the files referenced by the HLS playlists on disk, None without playlist
+        # The hls muxer writes segments in place and lists a segment once it is complete
+        references = None
+        for path in self.list_files():
+            if not path.endswith('.m3u8'):
+                continue
+            references = references or set()
+            try:
+                with open(path) as playlist:
+                    lines = playlist.read().splitlines()
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                line = line.strip()
+                uris = HLS_URI_PATTERN.findall(line) if line.startswith('#') else [line] if line else []
+                references.update(os.path.basename(urlparse(uri).path) for uri in uris)
+        return references
+
+    def is_new(self, path):
+        return path not in self.existing or os.path.getmtime(path) != self.existing[path]
+
+    def scan(self, final=False):
+        # Submit the segments that are complete, manifests are kept for the end
+        # HLS: a segment is complete once a playlist references it. Otherwise (DASH...) once its size settled
+        now = time.time()
+        references = self.playlist_references()
+        for path in self.list_files():
+            if path in self.futures or path.endswith('.tmp') or path.endswith(MANIFEST_EXTENSIONS):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Renamed by ffmpeg (hls temp_file) between the listing and the stat
+                continue
+            if not self.is_new(path):
+                continue
+            if references is not None:
+                settled = os.path.basename(path) in references
+            else:
+                settled = self.sizes.get(path) == stat.st_size and now - stat.st_mtime >= SEGMENT_SETTLE_TIME
+            self.sizes[path] = stat.st_size
+            if final or settled:
+                self.submit(path)
+
+    def watch(self):
+        while not self.stop_event.wait(DIRECTORY_POLL_INTERVAL):
+            self.scan()
+
+    def start(self):
+        self.thread.start()
+
+    def finish(self, upload_manifests=True):
+        # Stop watching, upload the remaining segments, then the manifests
+        self.stop_event.set()
+        self.thread.join()
+        try:
+            if upload_manifests:
+                self.scan(final=True)
+            segments = [future.result() for future in self.futures.values()]
+            # Uploaded while ffmpeg was still writing them: uploaded again, complete this time
+            rewritten = self.changed_since_submit()
+            if rewritten:
+                print(f"Uploading again {len(rewritten)} files written after their upload")
+                list(self.executor.map(self.upload, rewritten))
+            manifests = []
+            if upload_manifests:
+                manifest_paths = [path for path in self.list_files()
+                                  if path.endswith(MANIFEST_EXTENSIONS) and self.is_new(path)]
+                manifests = list(self.executor.map(self.upload, manifest_paths))
+        finally:
+            self.executor.shutdown(wait=True)
+        print(f"Uploaded {len(segments)} segments and {len(manifests)} manifests to s3://{self.bucket_name}/{self.s3_prefix}")
+        return segments, manifests
+
+def stream_input_url(url, s3_client):
+    # Function to get a URL ffmpeg can read directly, None if the input has to be staged in /tmp
+    if url.startswith('s3://'):
+        # S3 always serves byte ranges, so ffmpeg can seek in the presigned URL
+        parsed_s3 = urlparse(url)
+        return s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': parsed_s3.netloc, 'Key': parsed_s3.path.lstrip('/')},
+            ExpiresIn=PRESIGNED_URL_EXPIRY
+        )
+    if not url.startswith(('http://', 'https://')):
+        return None
+    if not os.path.basename(urlparse(url).path).lower().endswith(SEEKABLE_CONTAINERS):
+        return url
+    # Seekable container: only stream if the origin answers range requests
+    try:
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request, timeout=10) as response:
+            accept_ranges = response.headers.get('Accept-Ranges', '')
+    except Exception as e:
+        print(f"HEAD request failed for {url}: {e}")
+        return None
+    return url if 'bytes' in accept_ranges else None
+
+def probe_remux(input_path):
+    # Function to check if the input needs a remux pass: returns (needs_remux, reason)
+    # Only the container header is read: no -show_frames, no decoding
+    ffprobe_command = [
+        "ffprobe",
+        "-v", "trace",
+        "-print_format", "json",
+        "-show_format",
+        input_path
+    ]
+    result = subprocess.run(ffprobe_command, capture_output=True, text=True)
+    try:
+        probe_format = json.loads(result.stdout)['format']
+    except (ValueError, KeyError):
+        return True, 'probe failed'
+
+    format_names = probe_format.get('format_name', '').split(',')
+    if not any(name in MP4_FORMATS for name in format_names):
+        return True, f"container {probe_format.get('format_name')}"
+
+    # MP4 is only seekable from the start if the moov atom comes before mdat (faststart)
+    moov_index = result.stderr.find("type:'moov'")
+    mdat_index = result.stderr.find("type:'mdat'")
+    if moov_index == -1 or (mdat_index != -1 and mdat_index < moov_index):
+        return True, 'moov atom after mdat (no faststart)'
+
+    start_time = float(probe_format.get('start_time', 0) or 0)
+    if start_time < 0 or start_time > MAX_START_TIME:
+        return True, f"broken timestamps (start_time {start_time})"
+
+    return False, 'seekable mp4'
+
+def normalize_files(files, default_key):
+    # Function to accept both string and dict formats for input_files / output_files
+    if isinstance(files, str):
+        return {default_key: files}
+    return files
+
+def split_at_keyframes(keyframe_times, chunk_duration):
+    # Function to cut the input in chunks of at least chunk_duration, starting on keyframes
+    chunks = []
+    start = 0.0
+    for keyframe_time in keyframe_times:
+        if keyframe_time - start >= chunk_duration:
+            chunks.append({'index': len(chunks), 'start': start, 'end': keyframe_time})
+            start = keyframe_time
+    # Last chunk runs to the end of the input
+    chunks.append({'index': len(chunks), 'start': start, 'end': None})
+    return chunks
+
+def plan_chunks(job, s3_client, context):
+    # Step Functions "Plan Chunks": keyframe aligned split points for the Map state
+    input_files = normalize_files(job.get('input_files', {}), 'input_files')
+    output_files = normalize_files(job.get('output_files', {}), 'output_files')
+    if len(input_files) != 1 or len(output_files) != 1:
+        return {
+            'statusCode': 400,
+            'body': 'Chunked jobs require exactly one input file and one output file'
+        }
+    if job.get('ladder'):
+        # The renditions of a ladder are packaged together, they cannot be stitched from chunks
+        return {
+            'statusCode': 400,
+            'body': 'Chunked mode cannot be used with ladder jobs'
+        }
+    input_url = list(input_files.values())[0]
+    probe_url = stream_input_url(input_url, s3_client) or input_url
+
+    # Keyframe times only: the packets are enough, no need to decode the frames
+    try:
+        analysis = VideoAnalyzer(probe_url).frame_tables(mode='packets')
+    except ProbeError as e:
+        return {
+            'statusCode': 500,
+            'body': f'Keyframes of {input_url} could not be read: {e}'
+        }
+    if not analysis or not len(analysis['videoFrames']):
+        return {
+            'statusCode': 500,
+            'body': f'No video frames found in {input_url}'
+        }
+    # -ss on the input is relative to the container start time
+    start_time = float(analysis['format'].get('start_time', 0) or 0)
+    duration = float(analysis['format']['duration'])
+    keyframe_times = [keyframe_time - start_time for keyframe_time in analysis['videoFrames'].keyframe_times()]
+    chunk_duration = float(job.get('chunk_duration', DEFAULT_CHUNK_DURATION))
+    chunks = split_at_keyframes(keyframe_times, chunk_duration)
+    print(f"Planned {len(chunks)} chunks of ~{chunk_duration}s for {duration}s of video")
+
+    if job.get('preset') == 'auto':
+        # Chosen once from the probe above: every chunk is encoded with the same command
+        preset_name, ffmpeg_command, preset_reasons = select_preset(analysis, list(output_files)[0])
+        job = {**job, 'ffmpeg_command': ffmpeg_command, 'selected_preset': {'name': preset_name, 'reasons': preset_reasons}}
+        print(f"Preset: {job['selected_preset']}")
+
+    return {
+        'statusCode': 200,
+        'body': {
+            'job': job,
+            'duration': duration,
+            'chunks': chunks
+        }
+    }
+
+def chunk_s3_key(video_id, output_filename, index):
+    extension = os.path.splitext(output_filename)[1]
+    return f"ffmpeg/{video_id}/chunks/chunk_{index:05d}{extension}"
+
+def encode_chunk(job, chunk, s3_client, workspace, context):
+    # Step Functions "Encode Chunk": encode [start, end[ of the input with the job command
+    bucket_name = os.environ.get('BUCKET_NAME')
+    video_id = job.get('video_id', '')
+    input_url = list(normalize_files(job['input_files'], 'input_files').values())[0]
+    output_key, output_filename = list(normalize_files(job['output_files'], 'output_files').items())[0]
+
+    s3_key = chunk_s3_key(video_id, output_filename, chunk['index'])
+    local_path = workspace.file(os.path.basename(s3_key))
+
+    # Input seeking: the start is a keyframe so the cut is frame accurate
+    source = stream_input_url(input_url, s3_client) or input_url
+    seek_args = f"-ss {chunk['start']}"
+    if chunk['end'] is not None:
+        seek_args += f" -to {chunk['end']}"
+
+    cmd = job['ffmpeg_command'].replace(f"{{{{{output_key}}}}}", local_path)
+    cmd = cmd.replace("{{input_files}}", "")
+    global_args, cmd = apply_threading(cmd, available_cpus())
+    progress = FFmpegProgress()
+    ffmpeg_chunk = execute_ffmpeg(f"{global_args}{seek_args} {STREAM_INPUT_OPTIONS} -i {shlex.quote(source)} {cmd}", context, progress)
+    if isinstance(ffmpeg_chunk, dict):
+        return ffmpeg_chunk
+
+    print(f"Uploading {local_path} to s3://{bucket_name}/{s3_key}")
+    s3_client.upload_file(local_path, bucket_name, s3_key)
+    os.remove(local_path)
+    return {
+        'statusCode': 200,
+        'body': {
+            'index': chunk['index'],
+            's3_key': s3_key,
+            # Samples are left out to keep the Map state output small
+            'progress': progress.summary(with_samples=False)
+        }
+    }
+
+def concat_files(sources, local_path, context):
+    # Function to join files or URLs with the concat demuxer, without re-encoding
+    concat_list = f"{os.path.dirname(local_path)}/concat.txt"
+    with open(concat_list, 'w') as f:
+        for source in sources:
+            f.write(f"file '{source}'\n")
+    cmd_concat = f"-f concat -safe 0 -protocol_whitelist {CONCAT_PROTOCOLS} -i {concat_list} -c copy {shlex.quote(local_path)}"
+    return execute_ffmpeg(cmd_concat, context)
+
+def probe_duration(input_path):
+    # Function to get the duration (seconds) of a media from its container header
+    result = subprocess.run(
+        ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", input_path],
+        capture_output=True, text=True
+    )
+    try:
+        return float(json.loads(result.stdout)['format']['duration'])
+    except (ValueError, KeyError):
+        return None
+
+def probe_has_audio(input_path):
+    # Function to check if the input has at least one audio stream
+    result = subprocess.run(
+        ["ffprobe", "-v", "quiet", "-select_streams", "a", "-show_entries", "stream=index",
+         "-print_format", "json", input_path],
+        capture_output=True, text=True
+    )
+    try:
+        return len(json.loads(result.stdout).get('streams', [])) > 0
+    except ValueError:
+        return False
+
+def bitrate_kbps(bitrate):
+    # Function to convert an ffmpeg bitrate (3000k, 3M, 3000000) to kbit/s
+    bitrate = str(bitrate)
+    if bitrate[-1] in 'kK':
+        return float(bitrate[:-1])
+    if bitrate[-1] in 'mM':
+        return float(bitrate[:-1]) * 1000
+    return float(bitrate) / 1000
+
+def build_ladder_command(ladder, ladder_format, with_audio, audio_bitrate):
+    # Function to build one ffmpeg command decoding the source once and encoding every rendition
+    # Returns the command (with {{master}} and {{session_folder}} placeholders) and the output_files
+    count = len(ladder)
+    names = [re.sub(r'[^A-Za-z0-9_-]', '_', str(rendition.get('name', f"{rendition['height']}p"))) for rendition in ladder]
+    split_outputs = ''.join(f"[s{i}]" for i in range(count))
+    filters = [f"[0:v]split={count}{split_outputs}"]
+    encoders = []
+    for i, rendition in enumerate(ladder):
+        width = rendition.get('width', -2)
+        filters.append(f"[s{i}]scale={width}:{rendition['height']}[v{i}]")
+        video_bitrate = rendition['video_bitrate']
+        maxrate = rendition.get('maxrate', f"{int(bitrate_kbps(video_bitrate) * 1.1)}k")
+        bufsize = rendition.get('bufsize', f"{int(bitrate_kbps(video_bitrate) * 2)}k")
+        encoders.append(
+            f"-map \"[v{i}]\" -c:v:{i} {rendition.get('codec', DEFAULT_LADDER_CODEC)} "
+            f"-preset:v:{i} {rendition.get('preset', DEFAULT_LADDER_PRESET)} "
+            f"-b:v:{i} {video_bitrate} -maxrate:v:{i} {maxrate} -bufsize:v:{i} {bufsize}"
+        )
+    cmd = f"-filter_complex \"{';'.join(filters)}\" {' '.join(encoders)} -pix_fmt yuv420p"
+    # Same keyframe positions in every rendition so players can switch on segment boundaries
+    cmd += f" -force_key_frames \"expr:gte(t,n_forced*{LADDER_SEGMENT_DURATION})\" -sc_threshold 0"
+    if with_audio:
+        # Audio is encoded once and shared by all the renditions
+        cmd += f" -map 0:a:0 -c:a aac -b:a {audio_bitrate} -ac 2"
+
+    if ladder_format == 'dash':
+        adaptation_sets = "id=0,streams=v id=1,streams=a" if with_audio else "id=0,streams=v"
+        cmd += (
+            f" -f dash -seg_duration {LADDER_SEGMENT_DURATION} -use_template 1 -use_timeline 1"
+            f" -adaptation_sets \"{adaptation_sets}\" {{{{master}}}}"
+        )
+        return cmd, {'master': 'manifest.mpd'}
+
+    audio_group = ',agroup:audio' if with_audio else ''
+    stream_map = [f"v:{i}{audio_group},name:{name}" for i, name in enumerate(names)]
+    if with_audio:
+        stream_map.append("a:0,agroup:audio,name:audio")
+    cmd += (
+        f" -f hls -hls_time {LADDER_SEGMENT_DURATION} -hls_playlist_type vod"
+        f" -master_pl_name master.m3u8 -var_stream_map \"{' '.join(stream_map)}\""
+        f" -hls_segment_filename {{{{session_folder}}}}/%v_%05d.ts {{{{session_folder}}}}/%v.m3u8"
+    )
+    # The master playlist is written next to the variant playlists
+    return cmd, {'master': 'master.m3u8'}
+
+def select_preset(info, output_key='output_files'):
+    # Function to choose how a source is transcoded from its streams (VideoAnalyzer.stream_info)
+    # Returns the preset name, the ffmpeg command (writing to the {{output_key}} placeholder) and the reasons of the choice
+    output_placeholder = f"{{{{{output_key}}}}}"
+    video = info['video']
+    audio = info['audio']
+    height = to_number(video.get('height'), int) or 0
+    width = to_number(video.get('width'), int) or 0
+    bitrate = to_number(video.get('bit_rate'), int) or to_number(info['format'].get('bit_rate'), int) or 0
+    frame_rate = video.get('avg_frame_rate', '0/1').split('/')
+    fps = to_number(frame_rate[0]) / (to_number(frame_rate[1]) or 1) if len(frame_rate) == 2 and to_number(frame_rate[0]) else 0
+
+    reasons = []
+    if video.get('codec_name') not in TARGET_VIDEO_CODECS:
+        reasons.append(f"video codec {video.get('codec_name')}")
+    elif video.get('profile') not in TARGET_PROFILES:
+        reasons.append(f"profile {video.get('profile')}")
+    if video.get('pix_fmt') not in TARGET_PIX_FMTS:
+        reasons.append(f"pixel format {video.get('pix_fmt')}")
+    if height > TARGET_MAX_HEIGHT:
+        reasons.append(f"height {height}")
+    if bitrate > TARGET_MAX_VIDEO_BITRATE:
+        reasons.append(f"bitrate {bitrate}")
+    interlaced = video.get('field_order', 'progressive') not in ('progressive', 'unknown')
+    if interlaced:
+        reasons.append(f"interlaced ({video.get('field_order')})")
+    audio_compliant = not audio or audio.get('codec_name') in TARGET_AUDIO_CODECS
+    audio_args = "-c:a copy" if audio_compliant else PRESET_AUDIO
+
+    if not reasons:
+        # Already at the target spec: no re-encode
+        name = 'passthrough' if audio_compliant else 'audio_transcode'
+        reasons.append('video at target spec' + ('' if audio_compliant else f", audio codec {audio.get('codec_name')}"))
+        return name, f"{PRESET_MAPS} -c:v copy {audio_args} -movflags +faststart {output_placeholder}", reasons
+
+    filters = []
+    if interlaced:
+        filters.append("yadif")
+    if height > TARGET_MAX_HEIGHT:
+        filters.append(f"scale=-2:{TARGET_MAX_HEIGHT}")
+    bits_per_pixel = bitrate / (width * height * fps) if width and height and fps and bitrate else None
+    if interlaced or video.get('pix_fmt') not in TARGET_PIX_FMTS or (bits_per_pixel is not None and bits_per_pixel < LOW_BITS_PER_PIXEL):
+        # Needs more care: heavily compressed, interlaced or high bit depth source
+        filters.append("deband=range=16:1thr=0.02:2thr=0.02:3thr=0.02")
+        name = 'quality'
+        encoder = '-c:v libx264 -preset medium -crf 23 -pix_fmt yuv420p -profile:v high -x264-params "aq-mode=3:aq-strength=1.0"'
+    else:
+        name = 'standard'
+        encoder = '-c:v libx264 -preset veryfast -crf 23 -pix_fmt yuv420p -profile:v high'
+    filter_args = f'-vf "{",".join(filters)}" ' if filters else ''
+    return name, f"{PRESET_MAPS} {filter_args}{encoder} {PRESET_AUDIO} -movflags +faststart {output_placeholder}", reasons
+
+def available_cpus():
+    # Function to get the vCPUs this container can use: cgroup quota and CPU affinity, read once
+    global cpu_count
+    if cpu_count is not None:
+        return cpu_count
+    cpus = len(os.sched_getaffinity(0))
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            max_value, period = f.read().split()
+            if max_value != 'max':
+                quota = int(max_value) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota_us = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period_us = int(f.read())
+            if quota_us > 0:
+                quota = quota_us / period_us
+        except (OSError, ValueError):
+            pass
+    if quota:
+        cpus = min(cpus, max(1, int(quota + 0.5)))
+    cpu_count = cpus
+    return cpu_count
+
+def apply_threading(cmd, cpus):
+    # Function to set the encoder and filter threads to the vCPU count, unless the command sets them
+    # Returns the global options (before the inputs) and the updated command
+    global_args = ''
+    if '-filter_threads' not in cmd:
+        global_args += f"-filter_threads {cpus} "
+    if '-filter_complex' in cmd and '-filter_complex_threads' not in cmd:
+        global_args += f"-filter_complex_threads {cpus} "
+    caller_threads = re.search(r'(^|\s)-threads\s', cmd) is not None
+    if not caller_threads:
+        cmd = f"-threads {cpus} {cmd}"
+    # x264 params are applied after -threads: they would override the caller's value
+    if 'libx264' in cmd and not caller_threads:
+        x264_threads = f"threads={cpus}:lookahead-threads={max(1, cpus // 2)}"
+        x264_params = re.search(r'-x264-params\s+("([^"]*)"|\S+)', cmd)
+        if not x264_params:
+            cmd = f"-x264-params {x264_threads} {cmd}"
+        elif 'threads=' not in x264_params.group(1):
+            value = x264_params.group(2) if x264_params.group(2) is not None else x264_params.group(1)
+            cmd = cmd.replace(x264_params.group(0), f'-x264-params "{value}:{x264_threads}"', 1)
+    return global_args, cmd
+
+def children_cpu_time():
+    # CPU seconds used by the ffmpeg processes that have exited
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def get_ffmpeg_version():
+    # Function to get the first line of ffmpeg -version, read once per container
+    global ffmpeg_version
+    if ffmpeg_version is None:
+        result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True)
+        ffmpeg_version = result.stdout.split('\n')[0]
+    return ffmpeg_version
+
+def head_input(url, s3_client):
+    # Function to get the ETag and size of an input without reading it, empty values if unknown
+    try:
+        if url.startswith('s3://'):
+            parsed_s3 = urlparse(url)
+            head = s3_client.head_object(Bucket=parsed_s3.netloc, Key=parsed_s3.path.lstrip('/'))
+            return {'etag': head.get('ETag'), 'size': head.get('ContentLength')}
+        if url.startswith(('http://', 'https://')):
+            request = urllib.request.Request(url, method='HEAD')
+            with urllib.request.urlopen(request, timeout=10) as response:
+                size = response.headers.get('Content-Length')
+                return {'etag': response.headers.get('ETag'), 'size': int(size) if size else None}
+    except Exception as e:
+        print(f"HEAD request failed for {url}: {e}")
+    return {'etag': None, 'size': None}
+
+def video_analyzer(url, s3_client, use_cache=True):
+    # Function to analyze an input through its streaming URL, results cached under its ETag
+    identity = None
+    if use_cache:
+        head = head_input(url, s3_client)
+        if head['etag']:
+            identity = head
+    return VideoAnalyzer(
+        stream_input_url(url, s3_client) or url,
+        cache=analysis_cache if identity else None,
+        identity=identity
+    )
+
+def result_cache_key(input_heads, output_files, ffmpeg_command, video_id):
+    # Function to build the cache key of a job, None if an input has no ETag
+    etags = {key: head['etag'] for key, head in input_heads.items()}
+    if not all(etags.values()):
+        return None
+    identity = {
+        'inputs': etags,
+        # Output names are part of the key: the extension selects the muxer
+        'outputs': output_files,
+        # Outputs are under ffmpeg/<video_id>/: the URLs returned at submission must exist
+        'video_id': video_id,
+        'command': ' '.join(ffmpeg_command.split()),
+        'ffmpeg': get_ffmpeg_version()
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+def get_cached_result(s3_client, bucket_name, cache_key):
+    # Function to read a cache record, None when missing, expired or when an output is gone
+    try:
+        record = json.loads(s3_client.get_object(
+            Bucket=bucket_name, Key=f"{CACHE_PREFIX}/{cache_key}.json"
+        )['Body'].read())
+        if record['expires_at'] < time.time():
+            return None
+        for s3_key in record['s3_keys']:
+            s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+    except Exception as e:
+        print(f"Cache miss for {cache_key}: {e}")
+        return None
+    return record
+
+def put_cached_result(s3_client, bucket_name, cache_key, output_urls, s3_keys):
+    record = {
+        'output_files': output_urls,
+        's3_keys': s3_keys,
+        'created_at': time.time(),
+        'expires_at': time.time() + CACHE_TTL_SECONDS
+    }
+    s3_client.put_object(
+        Bucket=bucket_name, Key=f"{CACHE_PREFIX}/{cache_key}.json",
+        Body=json.dumps(record), ContentType='application/json'
+    )
+
+def checkpoint_s3_key(video_id, output_filename, index):
+    extension = os.path.splitext(output_filename)[1]
+    return f"ffmpeg/{video_id}/checkpoints/part_{index:05d}{extension}"
+
+def stitch_chunks(job, chunk_results, s3_client, workspace, context):
+    # Step Functions "Stitch Chunks": concat the encoded chunks without re-encoding
+    bucket_name = os.environ.get('BUCKET_NAME')
+    s3_hostname = os.environ.get('CLOUDFRONT_HOSTNAME')
+    video_id = job.get('video_id', '')
+    output_key, output_filename = list(normalize_files(job['output_files'], 'output_files').items())[0]
+
+    failed = [result for result in chunk_results if result.get('statusCode') != 200]
+    if failed:
+        return {
+            'statusCode': 500,
+            'body': f'{len(failed)} chunk(s) failed: {failed[0].get("body")}'
+        }
+    chunk_keys = [result['body']['s3_key'] for result in sorted(chunk_results, key=lambda r: r['body']['index'])]
+
+    # The concat demuxer reads the chunks straight from S3
+    chunk_urls = [stream_input_url(f"s3://{bucket_name}/{s3_key}", s3_client) for s3_key in chunk_keys]
+    local_path = workspace.file(output_filename)
+    ffmpeg_concat = concat_files(chunk_urls, local_path, context)
+    if isinstance(ffmpeg_concat, dict):
+        return ffmpeg_concat
+
+    s3_key = f'ffmpeg/{video_id}/{output_filename}'
+    print(f"Uploading {local_path} to s3://{bucket_name}/{s3_key}")
+    s3_client.upload_file(local_path, bucket_name, s3_key)
+    s3_client.delete_objects(
+        Bucket=bucket_name,
+        Delete={'Objects': [{'Key': key} for key in chunk_keys]}
+    )
+    return {
+        'statusCode': 200,
+        'body': {
+            'message': 'FFmpeg chunked processing completed successfully',
+            'video_id': video_id,
+            'output_files': {output_key: f"{s3_hostname}/{s3_key}"},
+            'chunks': len(chunk_keys),
+            'preset': job.get('selected_preset')
+        }
+    }
+
+def quality_check(job, s3_client):
+    # Delivery QC of the first input: bitrate timeline and VBV check from its packets (no download, no decoding)
+    input_files = normalize_files(job.get('input_files', {}), 'input_files')
+    if not input_files:
+        return {
+            'statusCode': 400,
+            'body': 'QC requires an input file'
+        }
+    input_url = list(input_files.values())[0]
+    maxrate = job.get('maxrate')
+    bufsize = job.get('bufsize')
+    try:
+        report = video_analyzer(input_url, s3_client, not job.get('no_cache')).bitrate_report(
+            read_intervals=job.get('read_intervals'),
+            window=float(job.get('window', 1)),
+            maxrate_kbps=bitrate_kbps(maxrate) if maxrate else None,
+            bufsize_kbit=bitrate_kbps(bufsize) if bufsize else None
+        )
+    except ProbeError as e:
+        return {
+            'statusCode': 500,
+            'body': f'QC of {input_url} failed: {e}'
+        }
+    if not report or not report['bitrate']:
+        return {
+            'statusCode': 500,
+            'body': f'No video frames found in {input_url}'
+        }
+    return {
+        'statusCode': 200,
+        'body': {'input': input_url, **report}
+    }
+
 def lambda_handler(event, context):
+    # The chunked mode steps carry the job in event['job']
+    job_status = JobStatus(event.get('job') or event)
+    result = process_job(event, context, job_status)
+    if event.get('action') == 'plan' and result.get('statusCode') == 200:
+        job_status.update('encoding', chunks=len(result['body']['chunks']))
+    elif event.get('action') != 'encode_chunk':
+        job_status.finish(result)
+    return result
+
+def process_job(event, context, job_status):
     bucket_name = os.environ.get('BUCKET_NAME')
     s3_hostname = os.environ.get('CLOUDFRONT_HOSTNAME')
-    s3_client = boto3.client('s3')
+
+    # Chunked mode steps called by the Step Function
+    action = event.get('action')
+    workspace = Workspace()
+    try:
+        if action == 'plan':
+            return plan_chunks(event['job'], s3_client, context)
+        if action == 'encode_chunk':
+            return encode_chunk(event['job'], event['chunk'], s3_client, workspace.create(), context)
+        if action == 'stitch':
+            return stitch_chunks(event['job'], event['chunks'], s3_client, workspace.create(), context)
+        if action == 'qc':
+            return quality_check(event, s3_client)
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'body': f'Error: {str(e)}'
+        }
+    finally:
+        workspace.cleanup()
     
+    workspace = Workspace()
     try:
         # Parse the payload
         input_files = event.get('input_files', {})
         output_files = event.get('output_files', {})
         ffmpeg_command = event.get('ffmpeg_command', '')
         video_id = event.get('video_id', '')
+        input_mode = event.get('input_mode', 'stream')
+        # Set when the job is resumed after a deadline stop
+        checkpoint = event.get('checkpoint') or {'offset': 0, 'parts': []}
+        ladder = event.get('ladder')
+        if ladder and input_files:
+            # ABR ladder: the command and the outputs are built from the rendition specs
+            first_url = list(normalize_files(input_files, 'input_files').values())[0]
+            with_audio = probe_has_audio(stream_input_url(first_url, s3_client) or first_url)
+            ffmpeg_command, output_files = build_ladder_command(
+                ladder, event.get('ladder_format', 'hls'), with_audio,
+                event.get('ladder_audio_bitrate', DEFAULT_LADDER_AUDIO_BITRATE)
+            )
+        preset = None
+        if event.get('preset') == 'auto' and event.get('output_mode') == 'stream':
+            # The preset commands write a faststart MP4, which needs a seekable output
+            return {
+                'statusCode': 400,
+                'body': 'preset auto cannot be used with output_mode stream'
+            }
+        if event.get('preset') == 'auto' and input_files:
+            # Adaptive preset: the command comes from the streams of the first input, for a single output
+            preset_outputs = normalize_files(output_files, 'output_files')
+            if len(preset_outputs) != 1:
+                return {
+                    'statusCode': 400,
+                    'body': 'preset auto requires exactly one output file'
+                }
+            first_url = list(normalize_files(input_files, 'input_files').values())[0]
+            info = video_analyzer(first_url, s3_client, not event.get('no_cache')).stream_info()
+            if info and info['video']:
+                preset_name, ffmpeg_command, preset_reasons = select_preset(info, list(preset_outputs)[0])
+                preset = {'name': preset_name, 'reasons': preset_reasons}
+            else:
+                # The command sent with the job is kept
+                preset = {'name': 'fallback', 'reasons': ['probe failed']}
+            print(f"Preset: {preset}")
+        output_mode = event.get('output_mode')
+        if not output_mode:
+            # HLS/DASH packaging writes segments next to the playlist
+            output_mode = 'directory' if PACKAGING_FORMAT_PATTERN.search(ffmpeg_command) else 'file'
         
     
         print(f"Received input_files: {input_files}")
         print(f"Received output_files: {output_files}")
         print(f"Received video_id: {video_id}")
         print(f"Received ffmpeg_command: {ffmpeg_command}")
+        print(f"Received input_mode: {input_mode}")
+        print(f"Received output_mode: {output_mode}")
         
         if not input_files or not output_files or not ffmpeg_command:
             return {
@@ -48,30 +1170,87 @@ def lambda_handler(event, context):
                 'body': 'Missing required fields: input_files, output_files, or ffmpeg_command'
             }
         
-        # Handle both string and dict formats for input_files
-        if isinstance(input_files, str):
-            input_files = {"input_files": input_files}
-        
-        # Handle string format for output_files
-        if isinstance(output_files, str):
-            output_files = {"output_files": output_files}
+        # Handle both string and dict formats for input_files and output_files
+        input_files = normalize_files(input_files, "input_files")
+        output_files = normalize_files(output_files, "output_files")
+
+        if output_mode == 'stream' and len(output_files) != 1:
+            return {
+                'statusCode': 400,
+                'body': 'output_mode stream requires exactly one output file'
+            }
+        stream_muxer = STREAM_MUXERS.get(os.path.splitext(list(output_files.values())[0])[1].lower()) if output_mode == 'stream' else None
+        if output_mode == 'stream' and not stream_muxer:
+            return {
+                'statusCode': 400,
+                'body': f"output_mode stream supports {', '.join(STREAM_MUXERS)} outputs"
+            }
         
         # Extract UUID from the first input file URL (not required)
         first_input_url = list(input_files.values())[0]
         parsed_url = urlparse(first_input_url)
         path_parts = parsed_url.path.strip('/').split('/')
         session_uuid = path_parts[0] if path_parts else str(uuid.uuid4())
+
+        # ETag and size of the inputs, read with HEAD requests
+        input_heads = {key: head_input(url, s3_client) for key, url in input_files.items()}
+
+        # Same inputs, command and ffmpeg version: return the outputs of the previous run
+        cache_key = None
+        if not event.get('no_cache'):
+            cache_key = result_cache_key(input_heads, output_files, ffmpeg_command, video_id)
+        if cache_key and not checkpoint['parts']:
+            cached = get_cached_result(s3_client, bucket_name, cache_key)
+            if cached:
+                print(f"Cache hit for {cache_key}")
+                return {
+                    'statusCode': 200,
+                    'body': {
+                        'message': 'FFmpeg result returned from cache',
+                        'session_uuid': session_uuid,
+                        'video_id': video_id,
+                        'output_files': cached['output_files'],
+                        'cache': {'key': cache_key, 'hit': True, 'created_at': cached['created_at']}
+                    }
+                }
         
-        session_folder = f"/tmp/{video_id}"
+        job_status.update('downloading', input_size=sum(head['size'] or 0 for head in input_heads.values()))
+        workspace.create()
+        session_folder = workspace.file(video_id or 'output')
 
         os.makedirs(session_folder, exist_ok=True)
         print(f"Using video ID: {video_id}")
         print(f"Created session folder: {session_folder}")
+
+        # Wall-clock time of each stage, in seconds
+        timings = {}
+        stage_start = time.time()
         
-        # Download input files to /tmp
+        # Stream input files when possible, download them to /tmp otherwise
         local_inputs = {}
+        input_args = {}
+        input_modes = {}
+        for key, url in input_files.items():
+            stream_url = stream_input_url(url, s3_client) if input_mode == 'stream' else None
+            if stream_url:
+                print(f"Streaming {key} from {url}")
+                local_inputs[key] = stream_url
+                input_args[key] = f"{STREAM_INPUT_OPTIONS} -i {shlex.quote(stream_url)}"
+                input_modes[key] = 'stream'
+                continue
+            input_modes[key] = 'download'
+
+        # Storage budget: only the sizes known up front, the downloaded inputs and the expected_output_size
+        # given by the caller (streamed inputs are never written to /tmp, outputs can be much smaller)
+        first_input_size = list(input_heads.values())[0]['size'] or 0
+        download_size = sum(input_heads[key]['size'] or 0 for key, mode in input_modes.items() if mode == 'download')
+        expected_output_size = int(event.get('expected_output_size') or 0) if output_mode != 'stream' else 0
+        workspace.reserve(download_size + expected_output_size)
+
         for key, url in input_files.items():
-            local_path = f"/tmp/{key}_{os.path.basename(urlparse(url).path)}"
+            if input_modes[key] == 'stream':
+                continue
+            local_path = workspace.file(f"{key}_{os.path.basename(urlparse(url).path)}")
             print(f"Processing {url} to {local_path}")
             
             if url.startswith('s3://'):
@@ -87,38 +1266,152 @@ def lambda_handler(event, context):
                 urllib.request.urlretrieve(url, local_path)
             
             local_inputs[key] = local_path
+            input_args[key] = f"-i {shlex.quote(local_path)}"
             print(f"Downloaded {key}: {local_path}")
         
+        timings['download'] = round(time.time() - stage_start, 3)
+
         # Prepare output file paths in session folder
         local_outputs = {}
         for key, filename in output_files.items():
-            local_outputs[key] = f"{session_folder}/{filename}"
+            # Streamed output is written by ffmpeg on stdout, with the muxer set from the output extension
+            local_outputs[key] = f"{stream_muxer} pipe:1" if output_mode == 'stream' else f"{session_folder}/{filename}"
         
         # Get the first input file for remuxing
         first_input_path = list(local_inputs.values())[0]
+        first_input_arg = list(input_args.values())[0]
         
-        # First stage: remux input file
-        tmp_remux_file = "/tmp/filename-source.mp4"
-        cmd_remux = f"-i {first_input_path} -c copy {tmp_remux_file}"
-        ffmpeg_remux = execute_ffmpeg(cmd_remux, context)
+        # First stage: remux input file, only when the container needs it
+        stage_start = time.time()
+        needs_remux, remux_reason = probe_remux(first_input_path)
+        print(f"Remux needed: {needs_remux} ({remux_reason})")
+        if needs_remux:
+            # The remuxed copy has about the size of the input
+            workspace.reserve(first_input_size)
+            tmp_remux_file = workspace.file("filename-source.mp4")
+            cmd_remux = f"{first_input_arg} -c copy {tmp_remux_file}"
+            ffmpeg_remux = execute_ffmpeg(cmd_remux, context)
+            if isinstance(ffmpeg_remux, dict):
+                # The remuxed copy is missing or partial (e.g. streamed input cut by a network error)
+                return ffmpeg_remux
+            source_input_arg = f"-i {tmp_remux_file}"
+        else:
+            source_input_arg = first_input_arg
+        timings['remux'] = round(time.time() - stage_start, 3)
         
 
         # Replace placeholders in ffmpeg command
         cmd = ffmpeg_command
         for key, path in local_outputs.items():
             cmd = cmd.replace(f"{{{{{key}}}}}", path)
-        # Remove any remaining input_files placeholder since we use remuxed file
+        # Remove any remaining input_files placeholder since the source is given with -i
         cmd = cmd.replace("{{input_files}}", "")
+        cmd = cmd.replace("{{session_folder}}", session_folder)
         
-        # Second stage: use remuxed file as input for final processing
-        cmd_final = f"-i {tmp_remux_file} {cmd}"
-        #cmd_final = f"-i {first_input_path} {cmd}"
-        ffmpeg_final = execute_ffmpeg(cmd_final, context)
+        # Single file jobs are stopped and checkpointed if they cannot finish before the timeout
+        deadline = None
+        if output_mode == 'file' and len(output_files) == 1 and context is not None:
+            total_duration = probe_duration(first_input_path)
+            if total_duration:
+                margin = float(event.get('checkpoint_margin', DEFAULT_CHECKPOINT_MARGIN))
+                deadline = DeadlineMonitor(context, total_duration, checkpoint['offset'], margin)
+
+        job_status.update('encoding', timings=timings)
+
+        # Threads matching the vCPUs of this function (the caller's settings are kept)
+        cpus = available_cpus()
+        global_args, cmd = apply_threading(cmd, cpus)
+
+        # Second stage: use remuxed file (or the original input) for final processing
+        seek_arg = f"-ss {checkpoint['offset']} " if checkpoint['offset'] else ""
+        cmd_final = f"{global_args}{seek_arg}{source_input_arg} {cmd}"
+        output_urls = {}
+        segments_uploaded = 0
+        progress = FFmpegProgress()
+        stage_start = time.time()
+        cpu_start = children_cpu_time()
+        upload_start = None
+        if output_mode == 'stream':
+            # Parts are uploaded while ffmpeg is encoding
+            key = list(output_files.keys())[0]
+            s3_key = f'ffmpeg/{video_id}/{output_files[key]}'
+            ffmpeg_final = execute_ffmpeg_to_s3(cmd_final, s3_client, bucket_name, s3_key, context, progress)
+            if not isinstance(ffmpeg_final, dict):
+                output_urls[key] = f"{s3_hostname}/{s3_key}"
+        elif output_mode == 'directory':
+            # Segments are uploaded while ffmpeg is encoding, manifests last
+            uploader = DirectoryUploader(s3_client, session_folder, bucket_name, f'ffmpeg/{video_id}')
+            uploader.start()
+            ffmpeg_final = execute_ffmpeg(cmd_final, context, progress)
+            upload_start = time.time()
+            segments, manifests = uploader.finish(upload_manifests=not isinstance(ffmpeg_final, dict))
+            for key, local_path in local_outputs.items():
+                if uploader.s3_key(local_path) in manifests + segments:
+                    output_urls[key] = f"{s3_hostname}/{uploader.s3_key(local_path)}"
+            segments_uploaded = len(segments)
+        else:
+            ffmpeg_final = execute_ffmpeg(cmd_final, context, progress, deadline)
+        upload_start = upload_start or time.time()
+        timings['encode'] = round(upload_start - stage_start, 3)
+        # Share of the available vCPUs that ffmpeg kept busy during the encode
+        cpu_utilisation = round((children_cpu_time() - cpu_start) / (max(timings['encode'], 0.001) * cpus), 3)
+        print(f"Encode CPU utilisation: {cpu_utilisation} of {cpus} vCPUs")
+        if isinstance(ffmpeg_final, dict):
+            return ffmpeg_final
+
+        if deadline and deadline.stopped:
+            # Keep the encoded prefix and let the Step Function start a new invocation
+            key, output_filename = list(output_files.items())[0]
+            part_duration = probe_duration(local_outputs[key])
+            if not part_duration:
+                return {
+                    'statusCode': 500,
+                    'body': 'Deadline reached before any output was encoded'
+                }
+            part_key = checkpoint_s3_key(video_id, output_filename, len(checkpoint['parts']))
+            print(f"Uploading checkpoint {local_outputs[key]} to s3://{bucket_name}/{part_key}")
+            s3_client.upload_file(local_outputs[key], bucket_name, part_key)
+            os.remove(local_outputs[key])
+            next_checkpoint = {
+                'offset': checkpoint['offset'] + part_duration,
+                'parts': checkpoint['parts'] + [part_key]
+            }
+            return {
+                'statusCode': 202,
+                'body': {
+                    'message': 'Deadline reached, job checkpointed',
+                    'status': 'continue',
+                    'video_id': video_id,
+                    'checkpoint': next_checkpoint,
+                    'estimated_remaining': deadline.estimated_remaining,
+                    'timings': timings,
+                    'progress': progress.summary(with_samples=False),
+                    'job': {**event, 'checkpoint': next_checkpoint}
+                }
+            }
+
+        job_status.update('uploading', timings=timings)
+
+        if checkpoint['parts']:
+            # Resumed job: the output is the concat of the checkpoints and of this last part
+            key, output_filename = list(output_files.items())[0]
+            last_part = f"{session_folder}/last_part{os.path.splitext(output_filename)[1]}"
+            os.replace(local_outputs[key], last_part)
+            part_urls = [stream_input_url(f"s3://{bucket_name}/{part_key}", s3_client) for part_key in checkpoint['parts']]
+            ffmpeg_concat = concat_files(part_urls + [last_part], local_outputs[key], context)
+            os.remove(last_part)
+            if isinstance(ffmpeg_concat, dict):
+                return ffmpeg_concat
         
         # Upload session folder to S3
-        output_urls = {}
+        # Streamed and directory outputs: size written by ffmpeg
+        output_size = 0 if output_mode == 'file' else progress.latest('total_size') or 0
         for key, local_path in local_outputs.items():
+            if key in output_urls:
+                # Already streamed to S3
+                continue
             if os.path.exists(local_path):
+                output_size += os.path.getsize(local_path)
                 s3_key = f'ffmpeg/{video_id}/{output_files[key]}'
                 print(f"Uploading {local_path} to s3://{bucket_name}/{s3_key}")
                 s3_client.upload_file(local_path, bucket_name, s3_key)
@@ -126,6 +1419,28 @@ def lambda_handler(event, context):
                 print(f"Uploaded {key}: {output_urls[key]}")
             else:
                 print(f"Output file not found: {local_path}")
+        timings['upload'] = round(time.time() - upload_start, 3)
+        if checkpoint['parts']:
+            s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': part_key} for part_key in checkpoint['parts']]}
+            )
+
+        # Partial results (an output not found) are not cached
+        if cache_key and len(output_urls) == len(output_files):
+            s3_keys = [url[len(s3_hostname) + 1:] for url in output_urls.values()]
+            put_cached_result(s3_client, bucket_name, cache_key, output_urls, s3_keys)
+
+        encode_progress = progress.summary()
+        emit_metrics(context, {
+            'DownloadTime': timings['download'] * 1000,
+            'RemuxTime': timings['remux'] * 1000,
+            'EncodeTime': timings['encode'] * 1000,
+            'UploadTime': timings['upload'] * 1000,
+            'EncodeFps': encode_progress['fps'] or 0,
+            'EncodeSpeed': encode_progress['speed'] or 0,
+            'CpuUtilisation': cpu_utilisation
+        })
         
         return {
             'statusCode': 200,
@@ -134,6 +1449,17 @@ def lambda_handler(event, context):
                 'session_uuid': session_uuid,
                 'video_id': video_id,
                 'output_files': output_urls,
+                'output_mode': output_mode,
+                'segments_uploaded': segments_uploaded,
+                'input_modes': input_modes,
+                'remux': {'performed': needs_remux, 'reason': remux_reason},
+                'checkpoints': len(checkpoint['parts']),
+                'cache': {'key': cache_key, 'hit': False},
+                'preset': preset,
+                'timings': timings,
+                'output_size': output_size,
+                'progress': encode_progress,
+                'cpu': {'vcpus': cpus, 'utilisation': cpu_utilisation},
                 'ffmpeg_stdout': ffmpeg_final
             }
         }
@@ -142,4 +1468,6 @@ def lambda_handler(event, context):
         return {
             'statusCode': 500,
             'body': f'Error: {str(e)}'
-        }
\ No newline at end of file
+        }
+    finally:
+        workspace.cleanup()
@@ -1,17 +1,22 @@
+import gzip
+import hashlib
 import json
+import math
 import os
-import xml.etree.ElementTree as ET
 import subprocess
 from urllib.parse import urlparse, parse_qs, urlencode, unquote, urlunparse, urljoin
 import re
 import sys
 from datetime import datetime, timedelta
 import time
-import urllib3
-from zoneinfo import ZoneInfo
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import uuid
 from decimal import Decimal, ROUND_HALF_UP
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from itertools import accumulate
 
 
 
@@ -42,11 +47,33 @@ Here are a list of all the functions to be used:
         -   filename_from_url(url) => #Function to provide a filename from URL without QS
         -   check_value_is_present(list_to_test,value)
         -   get_file_size(url)
+        -   http_pool() => shared urllib3 PoolManager, imported on first use
+        -   class Workspace(root) => per invocation folder in /tmp with storage budget
+            -   Workspace.create()
+            -   Workspace.reserve(size_bytes)
+            -   Workspace.cleanup()
 
     * Class for video :
-        -   class IFrame|BFrame|PFrame|GOP => to extract GOP
-        -   class VideoAnalyzer (file)
-            -   VideoAnalyzer.analyze
+        -   class FrameTable => columnar frames (array per field) to extract GOP
+            -   FrameTable.rows(video) => frame dicts
+            -   FrameTable.keyframe_times()
+            -   FrameTable.gop_bounds() / gop_structure(decoded) / gop_stats(decoded)
+            -   FrameTable.bitrate_timeline(window) => per second, sliding window peak and per GOP bitrates
+            -   FrameTable.vbv_check(maxrate_kbps, bufsize_kbit, initial_fill) => simulated VBV buffer, underflows
+        -   ffprobe_version()
+        -   file_identity(path) => size, mtime and hash of the first/last MB of a local file
+        -   class AnalysisCache(s3_client, bucket_name, prefix, ttl_seconds, max_entries, max_memory_bytes, max_object_bytes)
+            -   AnalysisCache.key(identity, analysis, options)
+            -   AnalysisCache.get(key) / put(key, result) / invalidate(key) => in-process LRU, then gzip JSON in S3
+        -   class VideoAnalyzer (file, cache, identity) => analyze, bitrate_report and stream_info results go through the cache
+            -   VideoAnalyzer.analyze(mode, read_intervals) => streams, format, frames, GOP structure and stats (ffprobe output streamed)
+                mode "frames" decodes every frame, mode "packets" reads the packets only (no frame types)
+            -   VideoAnalyzer.frame_tables(mode, read_intervals) => same as analyze with FrameTables, no frame dicts
+            -   VideoAnalyzer.bitrate_report(mode, read_intervals, window, maxrate_kbps, bufsize_kbit) => bitrate timeline and VBV check
+            -   VideoAnalyzer.analysis_lines(mode, read_intervals) => frames or packets as frame dicts
+            -   VideoAnalyzer.probe_lines(entries, extra_args) => ffprobe compact output, one dict per line
+                raises ProbeError when ffprobe fails, so a partial result is never returned or cached
+            -   VideoAnalyzer.stream_info => video/audio streams and format only (no frames)
         -   class DashManifestAnalyzer (manifest_file)
             -   DashManifestAnalyzer.manifest_info()
             -   DashManifestAnalyzer.period_manifest()
@@ -73,6 +100,60 @@ def delete_file(file):
         print(f"The file {file} does not exist.")
 
 
+#Error raised when the ephemeral storage is too small for a job
+class WorkspaceFullError(Exception):
+    pass
+
+
+#Class to give each invocation its own folder in /tmp
+class Workspace:
+    # Folders are named with this prefix so the ones left by a killed invocation can be found
+    PREFIX = 'ffmpeg-ws-'
+    # Space kept free for logs, ffmpeg temporary files, etc.
+    MARGIN_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, root='/tmp'):
+        self.root = root
+        self.path = os.path.join(root, f"{self.PREFIX}{uuid.uuid4()}")
+        self.reserved = 0
+
+    def create(self):
+        # A container runs one invocation at a time: any other workspace is stale
+        # (invocation stopped by a timeout, where no cleanup could run)
+        for name in os.listdir(self.root):
+            if name.startswith(self.PREFIX):
+                delete_file(os.path.join(self.root, name))
+        os.makedirs(self.path)
+        return self
+
+    def free_space(self):
+        return shutil.disk_usage(self.root).free
+
+    def used_space(self):
+        used = 0
+        for folder, _, files in os.walk(self.path):
+            used += sum(os.path.getsize(os.path.join(folder, name)) for name in files)
+        return used
+
+    def reserve(self, size_bytes):
+        # Check the storage budget before writing size_bytes more in the workspace
+        # Space reserved earlier but not written yet is not available
+        pending = max(self.reserved - self.used_space(), 0)
+        free = self.free_space() - pending - self.MARGIN_BYTES
+        if size_bytes > free:
+            raise WorkspaceFullError(
+                f"Not enough ephemeral storage: {size_bytes} bytes needed, {max(free, 0)} available"
+            )
+        self.reserved += size_bytes
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        if os.path.exists(self.path):
+            delete_file(self.path)
+
+
 #Function to concatenate all fmp4 in a single file
 def concatenate_files(input_files, output_file):
     # Concatenate a List of files
@@ -101,6 +182,19 @@ def copy_file_to_s3(bucket_name,s3_client,file_name,s3_key):
             'body': 'Failed to upload file.'
         }
    
+#Function to get the HTTP connection pool, created on first use and kept for warm invocations
+#urllib3 is only imported by the functions making HTTP requests (cold start)
+http_pool_manager = None
+def http_pool():
+    global http_pool_manager
+    if http_pool_manager is None:
+        import urllib3
+        http_pool_manager = urllib3.PoolManager(
+            retries=urllib3.Retry(total=3, backoff_factor=0.5),
+            timeout=urllib3.Timeout(connect=5, read=60)
+        )
+    return http_pool_manager
+
 #Function to download a HTTP url on Lambda
 def HTTP_download( url_input, headers_in, folder ):
     """Function to download through HTTP GET. Retrieves download time and headers
@@ -125,7 +219,7 @@ def HTTP_download( url_input, headers_in, folder ):
     """
     try:
         #manifest_req=HTTP_download(manifest_url,headers_in,folder_name)
-        http = urllib3.PoolManager()
+        http = http_pool()
         start_time = time.time()
         response = http.request('GET', url_input, headers=headers_in,preload_content=False)
         end_time = time.time()
@@ -226,7 +320,8 @@ def check_value_is_present(list_to_test,value):
       
 #Function to get the filesize of a URL
 def get_file_size(url):
-    http = urllib3.PoolManager()
+    import urllib3
+    http = http_pool()
 
     try:
         response = http.request('HEAD', url)
@@ -317,194 +412,526 @@ def convert_duration_to_hms(duration):
 
 
 ##### VIDEO ANALYSIS ######
-class BFrame(object):
-    def __repr__(self, *args, **kwargs):
-        return "B"
-    
-    def __str__(self, *args, **kwargs):
-        return repr(self)
-
-class PFrame(object):
-    def __repr__(self, *args, **kwargs):
-        return "P"
+# Picture type letters of FrameTable.types and the frame type reported in the frame dicts
+FRAME_TYPES = {ord('I'): 'I', ord('i'): 'I', ord('P'): 'P', ord('B'): 'B', ord('.'): None}
 
-    def __str__(self, *args, **kwargs):
-        return repr(self)
+def optional_time(value):
+    # Missing timestamps are stored as NaN in the frame tables
+    return None if math.isnan(value) else value
 
-class IFrame(object):
-    
+class FrameTable:
+    # Columnar frame table: one array per field instead of one dict/object per frame
+    # types holds one letter per frame: I (keyframe), i (non key I), P, B, . (unknown/packet)
+    # GOP segmentation and statistics run as regex scans over types
     def __init__(self):
-        self.key_frame = False
+        self.frame_index = array('q')
+        self.types = bytearray()
+        self.key_frame = array('b')
+        self.size = array('q')
+        self.pos = array('q')
+        self.dts = array('d')
+        # Presentation timestamps: seeking (-ss/-to) works on PTS
+        self.pts = array('d')
+        self.duration = array('d')
+
+    def __len__(self):
+        return len(self.size)
 
-    def __repr__(self, *args, **kwargs):
-        if self.key_frame:
-            return "I"
+    def append(self, frame_index, jframe):
+        pict_type = jframe.get('pict_type')
+        key_frame = int(jframe['key_frame']) if jframe.get('key_frame') is not None else -1
+        if pict_type == 'I':
+            self.types.append(ord('I') if key_frame == 1 else ord('i'))
+        elif pict_type in ('P', 'B'):
+            self.types.append(ord(pict_type))
         else:
-            return "i"
-        
-    def __str__(self, *args, **kwargs):
-        return repr(self)
+            self.types.append(ord('.'))
+        self.frame_index.append(frame_index)
+        self.key_frame.append(key_frame)
+        self.size.append(int(jframe.get('pkt_size') or 0))
+        self.pos.append(int(jframe['pkt_pos']) if jframe.get('pkt_pos') is not None else -1)
+        self.dts.append(float(jframe['pkt_dts_time']) if jframe.get('pkt_dts_time') is not None else math.nan)
+        pts_time = jframe.get('pts_time') or jframe.get('best_effort_timestamp_time')
+        self.pts.append(float(pts_time) if pts_time is not None else math.nan)
+        self.duration.append(float(jframe['duration_time']) if jframe.get('duration_time') is not None else math.nan)
 
-class GOP(object):
-    
-    def __init__(self):
-        self.closed = False
-        self.frames = []
-        
-    def add_frame(self, frame):
-        self.frames.append(frame)
-        
-        if isinstance(frame, IFrame) and frame.key_frame:
-            self.closed = True
-            
-    def __repr__(self, *args, **kwargs):
-        frames_repr = ''
-        
-        for frame in self.frames:
-            frames_repr += str(frame)
-        
-        gtype = 'CLOSED' if self.closed else 'OPEN'
-        
-        return 'GOP: {frames} {count} {gtype}'.format(frames=frames_repr, 
-                                                      count=len(self.frames), 
-                                                      gtype=gtype)
+    def rows(self, video=True):
+        # Function to build the frame dicts of VideoAnalyzer.analyze (videoFrames/audioFrames)
+        rows = []
+        for i in range(len(self)):
+            row = {
+                'frame_index': self.frame_index[i],
+                'size_bytes': self.size[i],
+                'duration_time': optional_time(self.duration[i]),
+                'pkt_dts_time': optional_time(self.dts[i])
+            }
+            if video:
+                row['pts_time'] = optional_time(self.pts[i])
+                row['pkt_pos'] = self.pos[i] if self.pos[i] >= 0 else None
+                row['type'] = FRAME_TYPES[self.types[i]]
+                row['key_frame'] = self.key_frame[i] if self.key_frame[i] >= 0 else None
+            rows.append(row)
+        return rows
+
+    def keyframe_times(self):
+        # Function to list the presentation timestamps of the frames flagged as keyframes (split points for -ss)
+        # With B-frames the DTS of a keyframe is earlier than its PTS: a cut on the DTS would start in the previous GOP
+        return sorted(
+            self.pts[i] for i in range(len(self))
+            if self.key_frame[i] == 1 and not math.isnan(self.pts[i])
+        )
+
+    def gop_bounds(self):
+        # Function to split the frames in GOPs: an I frame and the frames up to the next one
+        # The frames before the first I frame make a GOP too
+        starts = [match.start() for match in re.finditer(rb'[Ii]', self.types)]
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        ends = starts[1:] + [len(self.types)]
+        return [(start, end) for start, end in zip(starts, ends) if end > start]
+
+    def gop_structure(self, decoded=True):
+        # gopStructure view: frame types and OPEN/CLOSED status need decoded frames
+        if not decoded:
+            return [{"gop": None, "size": end - start, "status": None} for start, end in self.gop_bounds()]
+        return [{
+            "gop": self.types[start:end].decode(),
+            "size": end - start,
+            "status": "CLOSED" if self.types[start] == ord('I') else "OPEN"
+        } for start, end in self.gop_bounds()]
+
+    def gop_stats(self, decoded=True):
+        # Function to summarize the GOPs: sizes, keyframe cadence, closed GOPs and B-frame runs
+        bounds = self.gop_bounds()
+        if not bounds:
+            return {}
+        sizes = [end - start for start, end in bounds]
+        keyframes = [match.start() for match in re.finditer(rb'I', self.types)]
+        intervals = Counter(second - first for first, second in zip(keyframes, keyframes[1:]))
+        keyframe_times = [self.dts[i] for i in keyframes if not math.isnan(self.dts[i])]
+        interval_seconds = [second - first for first, second in zip(keyframe_times, keyframe_times[1:])]
+        stats = {
+            "count": len(sizes),
+            "minSize": min(sizes),
+            "maxSize": max(sizes),
+            "meanSize": round(sum(sizes) / len(sizes), 2),
+            # Frames between two keyframes => number of intervals
+            "keyframeIntervals": {str(interval): count for interval, count in sorted(intervals.items())},
+            "keyframeIntervalSeconds": {
+                "min": round(min(interval_seconds), 3),
+                "max": round(max(interval_seconds), 3),
+                "mean": round(sum(interval_seconds) / len(interval_seconds), 3)
+            } if interval_seconds else None,
+            "closedRatio": None,
+            "bFrameRuns": None
+        }
+        if decoded:
+            closed = sum(1 for start, _ in bounds if self.types[start] == ord('I'))
+            stats["closedRatio"] = round(closed / len(bounds), 3)
+            # Consecutive B frames => number of runs
+            runs = Counter(len(match.group()) for match in re.finditer(rb'B+', self.types))
+            stats["bFrameRuns"] = {str(length): count for length, count in sorted(runs.items())}
+        return stats
+
+    def timed_bits(self):
+        # Function to list (dts, size in bits) of the frames with a timestamp, in decoding order
+        return [(self.dts[i], self.size[i] * 8) for i in range(len(self)) if not math.isnan(self.dts[i])]
+
+    def bitrate_timeline(self, window=1.0):
+        # Function to compute the bitrate per second, the peak over a sliding window and per GOP (kbit/s)
+        # Every window sum is a difference of prefix sums of the frame sizes
+        frames = self.timed_bits()
+        if not frames:
+            return {}
+        times = [frame_time for frame_time, _ in frames]
+        bits = list(accumulate((frame_bits for _, frame_bits in frames), initial=0))
+        start = times[0]
+        last_duration = self.duration[-1] if len(self) and not math.isnan(self.duration[-1]) else 0
+        end = times[-1] + last_duration
+        duration = max(end - start, 0.001)
+
+        # Per second: frames in [second, second + 1[
+        seconds = max(int(math.ceil(end - start)), 1)
+        boundaries = [bisect_left(times, start + second) for second in range(seconds)] + [len(times)]
+        per_second = [round((bits[last] - bits[first]) / 1000, 1) for first, last in zip(boundaries, boundaries[1:])]
+
+        # Sliding window starting on each frame: [t, t + window[
+        peak_bits, peak_time, last = 0, start, 0
+        for first, frame_time in enumerate(times):
+            while last < len(times) and times[last] < frame_time + window:
+                last += 1
+            if bits[last] - bits[first] > peak_bits:
+                peak_bits, peak_time = bits[last] - bits[first], frame_time
+
+        # Per GOP: from the GOP first frame to the next GOP first frame
+        all_bits = list(accumulate((size * 8 for size in self.size), initial=0))
+        gop_kbps = []
+        for first, last in self.gop_bounds():
+            gop_start = self.dts[first]
+            gop_end = self.dts[last] if last < len(self) else end
+            if not math.isnan(gop_start) and not math.isnan(gop_end) and gop_end > gop_start:
+                gop_kbps.append(round((all_bits[last] - all_bits[first]) / (gop_end - gop_start) / 1000, 1))
+
+        return {
+            "duration": round(duration, 3),
+            "averageKbps": round(bits[-1] / duration / 1000, 1),
+            "window": window,
+            "peakKbps": round(peak_bits / window / 1000, 1),
+            "peakTime": round(peak_time - start, 3),
+            "perSecondKbps": per_second,
+            "gopKbps": gop_kbps
+        }
+
+    def vbv_check(self, maxrate_kbps, bufsize_kbit, initial_fill=0.9, max_violations=100):
+        # Function to simulate the decoder buffer (VBV/HRD leaky bucket): filled at maxrate up to bufsize,
+        # each frame is removed at its DTS. An underflow means the frame was not fully received in time
+        frames = self.timed_bits()
+        if not frames:
+            return {}
+        rate = maxrate_kbps * 1000
+        buffer_size = bufsize_kbit * 1000
+        fill = buffer_size * initial_fill
+        start = previous = frames[0][0]
+        min_fill = fill
+        underflows = 0
+        violations = []
+        # Lowest buffer level of each second, in percent of bufsize
+        fill_timeline = []
+        for frame_time, frame_bits in frames:
+            fill = min(buffer_size, fill + rate * max(frame_time - previous, 0))
+            previous = frame_time
+            fill -= frame_bits
+            # Whole bits: an exactly empty buffer is not an underflow
+            if round(fill) < 0:
+                underflows += 1
+                if len(violations) < max_violations:
+                    violations.append({"time": round(frame_time - start, 3), "deficitBits": round(-fill)})
+            fill = max(fill, 0)
+            min_fill = min(min_fill, fill)
+            second = int(frame_time - start)
+            while len(fill_timeline) <= second:
+                fill_timeline.append(None)
+            level = round(fill / buffer_size * 100, 1)
+            if fill_timeline[second] is None or level < fill_timeline[second]:
+                fill_timeline[second] = level
+
+        return {
+            "maxrateKbps": maxrate_kbps,
+            "bufsizeKbit": bufsize_kbit,
+            "initialFill": initial_fill,
+            "compliant": underflows == 0,
+            "underflows": underflows,
+            "violations": violations,
+            "minFillPercent": round(min_fill / buffer_size * 100, 1),
+            "fillTimeline": fill_timeline
+        }
+
+# First line of ffprobe -version, read once per container (part of the analysis cache keys)
+ffprobe_version_line = None
+
+def ffprobe_version():
+    global ffprobe_version_line
+    if ffprobe_version_line is None:
+        result = subprocess.run(["ffprobe", "-version"], capture_output=True, text=True)
+        ffprobe_version_line = result.stdout.split('\n')[0]
+    return ffprobe_version_line
+
+def file_identity(path, sample_bytes=1024 * 1024):
+    # Function to identify a local file without reading it all: size, mtime and hash of its first/last MB
+    try:
+        size = os.path.getsize(path)
+        mtime = int(os.path.getmtime(path))
+    except OSError:
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        digest.update(file.read(sample_bytes))
+        if size > sample_bytes:
+            file.seek(max(size - sample_bytes, sample_bytes))
+            digest.update(file.read(sample_bytes))
+    return {'size': size, 'mtime': mtime, 'sample_sha256': digest.hexdigest()}
+
+#Class to cache the VideoAnalyzer results: in-process LRU (warm containers), then gzip JSON records in S3
+class AnalysisCache:
+
+    def __init__(self, s3_client=None, bucket_name=None, prefix="cache/analysis", ttl_seconds=6 * 24 * 3600,
+                 max_entries=16, max_memory_bytes=64 * 1024 * 1024, max_object_bytes=100 * 1024 * 1024):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        # In-process tier: compressed records, least recently used dropped first
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        # Larger results are not written to S3
+        self.max_object_bytes = max_object_bytes
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+
+    def key(self, identity, analysis, options):
+        # Content identity + analysis + its options + ffprobe version: a new ffprobe invalidates everything
+        key_fields = {
+            'identity': identity,
+            'analysis': analysis,
+            'options': options,
+            'ffprobe': ffprobe_version()
+        }
+        return hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+
+    def s3_key(self, key):
+        return f"{self.prefix}/{key}.json.gz"
+
+    def remember(self, key, expires_at, payload):
+        # Function to add a record to the in-process tier within the entries/bytes limits
+        self.forget(key)
+        if len(payload) > self.max_memory_bytes or self.max_entries < 1:
+            return
+        self.entries[key] = (expires_at, payload)
+        self.memory_bytes += len(payload)
+        while len(self.entries) > self.max_entries or self.memory_bytes > self.max_memory_bytes:
+            _, (_, dropped) = self.entries.popitem(last=False)
+            self.memory_bytes -= len(dropped)
+
+    def forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.memory_bytes -= len(entry[1])
+
+    def get(self, key):
+        # Function to read a result, None when missing or expired
+        entry = self.entries.get(key)
+        if entry and entry[0] >= time.time():
+            self.entries.move_to_end(key)
+            return json.loads(gzip.decompress(entry[1]))['result']
+        self.forget(key)
+        if not (self.s3_client and self.bucket_name):
+            return None
+        try:
+            payload = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.s3_key(key))['Body'].read()
+            record = json.loads(gzip.decompress(payload))
+        except Exception as e:
+            print(f"Analysis cache miss for {key}: {e}")
+            return None
+        if record['expires_at'] < time.time():
+            return None
+        self.remember(key, record['expires_at'], payload)
+        return record['result']
+
+    def put(self, key, result):
+        record = {
+            'result': result,
+            'created_at': time.time(),
+            'expires_at': time.time() + self.ttl_seconds
+        }
+        payload = gzip.compress(json.dumps(record).encode(), compresslevel=6)
+        self.remember(key, record['expires_at'], payload)
+        if self.s3_client and self.bucket_name and len(payload) <= self.max_object_bytes:
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.bucket_name, Key=self.s3_key(key),
+                    Body=payload, ContentType='application/gzip'
+                )
+            except Exception as e:
+                # The result is returned anyway, only the next lookups miss
+                print(f"Analysis cache write failed for {key}: {e}")
+
+    def invalidate(self, key):
+        self.forget(key)
+        if self.s3_client and self.bucket_name:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=self.s3_key(key))
+
+#Error raised when ffprobe exits with an error while its output is streamed
+class ProbeError(Exception):
+    pass
 
 class VideoAnalyzer:
     
-    def __init__(self, video_file):
+    def __init__(self, video_file, cache=None, identity=None):
         self.video_file = video_file
+        # Optional AnalysisCache: identity is the content identity of the file (e.g. its S3 ETag),
+        # read from the file itself (size, mtime, partial hash) when it is local
+        self.cache = cache
+        self.identity = identity
+
+    def cached(self, analysis, options, compute):
+        # Function to return a result from the cache, or to compute and cache it
+        if self.cache is None:
+            return compute()
+        identity = self.identity or file_identity(self.video_file)
+        if identity is None:
+            return compute()
+        key = self.cache.key(identity, analysis, options)
+        result = self.cache.get(key)
+        if result is not None:
+            print(f"Analysis cache hit for {analysis} {options}")
+            return result
+        result = compute()
+        if result is not None:
+            self.cache.put(key, result)
+        return result
+
+    # Frame fields read by analyze(): ffprobe prints one line per frame, nothing else is kept
+    FRAME_ENTRIES = "frame=media_type,key_frame,pkt_size,pkt_pos,pkt_dts_time,pts_time,best_effort_timestamp_time,duration_time,pict_type"
+    PACKET_ENTRIES = "packet=codec_type,flags,size,pos,dts_time,pts_time,duration_time"
 
-    def analyze(self):
+    def probe_lines(self, entries, extra_args=()):
+        # Function to stream ffprobe output line by line (compact format) as dicts
+        # Only the current line is held in memory, whatever the length of the file
+        ffprobe_command = [
+            "ffprobe",
+            "-v", "error",
+            *extra_args,
+            "-show_entries", entries,
+            "-print_format", "compact=print_section=0",
+            self.video_file
+        ]
+        process = subprocess.Popen(ffprobe_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True, bufsize=1024 * 1024)
+        # stderr is drained while stdout is read (a stream of errors cannot block ffprobe), last lines kept
+        errors = deque(maxlen=20)
+        stderr_reader = threading.Thread(target=errors.extend, args=(process.stderr,), daemon=True)
+        stderr_reader.start()
+        completed = False
+        try:
+            for line in process.stdout:
+                entry = {}
+                for item in line.rstrip("\n").split("|"):
+                    key, _, value = item.partition("=")
+                    entry[key] = None if value == "N/A" else value
+                yield entry
+            completed = True
+        finally:
+            if not completed:
+                # The caller stopped reading
+                process.kill()
+            process.stdout.close()
+            returncode = process.wait()
+            stderr_reader.join()
+            process.stderr.close()
+        # A truncated read (network error, corrupt file...) must not pass for the whole file
+        if returncode != 0:
+            raise ProbeError(f"ffprobe exited with code {returncode}: {''.join(errors).strip()}")
+
+    def analysis_lines(self, mode, read_intervals=None):
+        # Function to stream frames (decoded) or packets (demuxed only) with the same field names
+        extra_args = ["-read_intervals", read_intervals] if read_intervals else []
+        if mode == "frames":
+            yield from self.probe_lines(self.FRAME_ENTRIES, extra_args + ["-show_frames"])
+            return
+        for packet in self.probe_lines(self.PACKET_ENTRIES, extra_args + ["-show_packets"]):
+            key_frame = 1 if "K" in (packet.get("flags") or "") else 0
+            yield {
+                "media_type": packet.get("codec_type"),
+                "key_frame": key_frame,
+                "pkt_size": packet.get("size"),
+                "pkt_pos": packet.get("pos"),
+                "pkt_dts_time": packet.get("dts_time"),
+                "pts_time": packet.get("pts_time"),
+                "duration_time": packet.get("duration_time"),
+                # Picture types need decoding: only keyframes are known from the packets
+                "pict_type": "I" if key_frame else None
+            }
+
+    def frame_tables(self, mode="frames", read_intervals=None):
+        # Streams/format from the headers, then one pass over the frames streamed by ffprobe
+        # mode "packets": no decoding, keyframes/sizes/timestamps only (GOP length, cadence, bitrate)
+        # read_intervals: ffprobe -read_intervals syntax (e.g. "60%+30") to analyze a part of the file
+        if mode not in ("frames", "packets"):
+            raise ValueError(f"Unknown analysis mode {mode}")
+        info = self.stream_info()
+        if not info:
+            return None
+
+        video_frames = FrameTable()
+        audio_frames = FrameTable()
+        for frame_index, jframe in enumerate(self.analysis_lines(mode, read_intervals)):
+            media_type = jframe.get("media_type")
+            if media_type == "video":
+                video_frames.append(frame_index, jframe)
+            elif media_type == "audio":
+                audio_frames.append(frame_index, jframe)
+        info["videoFrames"] = video_frames
+        info["audioFrames"] = audio_frames
+        return info
+
+    def analyze(self, mode="frames", read_intervals=None):
+        return self.cached("analyze", {"mode": mode, "read_intervals": read_intervals},
+                           lambda: self.build_analysis(mode, read_intervals))
+
+    def build_analysis(self, mode, read_intervals):
+        # Frame dicts and GOP structure/statistics built from frame_tables()
+        tables = self.frame_tables(mode, read_intervals)
+        if not tables:
+            return None
+        video_frames = tables["videoFrames"]
+        decoded = mode == "frames"
+        with_gops = bool(tables["video"]) and len(video_frames) > 0
+        if tables["video"]:
+            tables["video"]['maxGopSize'] = max((end - start for start, end in video_frames.gop_bounds()), default=0)
+
+        results = {
+            "video": tables["video"],
+            "videoFrames": video_frames.rows(),
+            "audio": tables["audio"],
+            "audioFrames": tables["audioFrames"].rows(video=False),
+            "format": tables["format"],
+            "gopStructure": video_frames.gop_structure(decoded) if with_gops else [],
+            "gopStats": video_frames.gop_stats(decoded) if with_gops else {}
+        }
+        return results
+
+    def bitrate_report(self, mode="packets", read_intervals=None, window=1.0, maxrate_kbps=None, bufsize_kbit=None):
+        options = {
+            "mode": mode,
+            "read_intervals": read_intervals,
+            "window": window,
+            "maxrate_kbps": maxrate_kbps,
+            "bufsize_kbit": bufsize_kbit
+        }
+        return self.cached("bitrate_report", options,
+                           lambda: self.build_bitrate_report(mode, read_intervals, window, maxrate_kbps, bufsize_kbit))
+
+    def build_bitrate_report(self, mode, read_intervals, window, maxrate_kbps, bufsize_kbit):
+        # Bitrate timeline of the video and VBV check when maxrate/bufsize are given (delivery QC)
+        tables = self.frame_tables(mode, read_intervals)
+        if not tables:
+            return None
+        video_frames = tables["videoFrames"]
+        return {
+            "format": tables["format"],
+            "bitrate": video_frames.bitrate_timeline(window),
+            "vbv": video_frames.vbv_check(maxrate_kbps, bufsize_kbit) if maxrate_kbps and bufsize_kbit else None
+        }
+
+    def stream_info(self):
+        return self.cached("stream_info", {}, self.read_stream_info)
+
+    def read_stream_info(self):
+        # Same "video", "audio" and "format" entries as analyze(), read from the headers only
         ffprobe_command = [
             "ffprobe",
             "-v", "quiet",
             "-print_format", "json",
             "-show_format",
             "-show_streams",
-            "-show_frames",
             self.video_file
         ]
         result = subprocess.run(ffprobe_command, capture_output=True, text=True)
-        #resul=subprocess.call(['ffprobe', '-i', self.video_file])
-   
-        ffprobe_output = json.loads(result.stdout)
-        if ffprobe_output:
-            
-            # Extract video stream information
-            video_streams = [stream for stream in ffprobe_output['streams'] if stream['codec_type'] == 'video']
-            if video_streams:
-                video_stream = video_streams[0]  # Assuming only one video stream
-
-                video_frames = ffprobe_output["frames"]
-                #GOP Structure
-                gop_count = 0
-                gop_structure = []
-                gop = GOP()
-                gop_structure.append(gop)
-                for jframe in video_frames:
-                    if jframe["media_type"] == "video":
-                        
-                        frame = None
-                        
-                        if jframe["pict_type"] == 'I':
-                            if len(gop.frames):
-                                # GOP open and new iframe. Time to close GOP
-                                gop = GOP()
-                                gop_structure.append(gop)
-                            frame = IFrame()
-                            if jframe["key_frame"] == 1:
-                                frame.key_frame = True
-                        elif jframe["pict_type"] == 'P':
-                            frame = PFrame()
-                        elif jframe["pict_type"] == 'B':
-                            frame = BFrame()
-                        
-                        frame.json = jframe
-                        gop.add_frame(frame)
-                max_gop_size=max(len(sublist.frames) for sublist in gop_structure)
-                
-                pattern = r"GOP:\s+([A-Z]+)\s+(\d+)\s+(CLOSED|OPEN)"
-    
-            
-                gop_structure_dict=[]
-                for gop_value in gop_structure:
-                    # Search the string with the regular expression
-                    match = re.search(pattern, str(gop_value))
-                    if match:
-                        # Extract values
-                        gop_struct={
-                            "gop": match.group(1),
-                            "size": int(match.group(2)),
-                            "status": match.group(3)
-                            
-                        }
-                        gop_structure_dict.append(gop_struct)
-
-                        
-                dict_video=video_stream
-                dict_video['maxGopSize']=max_gop_size
-                
-            else:
-                dict_video={}
-
-            
-            # Extract video/audio frames
-            video_frames = []
-            audio_frames = []
-            video_frames_small=[]
-            audio_frames_small=[]
-            frames=ffprobe_output["frames"]
-
-            for i in range(len(frames)-1):
-                dict_obj={}
-                if frames[i]["media_type"] == "video":
-                    dict_obj = {
-                        'frame_index': i,
-                        'size_bytes': int(frames[i]['pkt_size']),
-                        'duration_time': check_value_is_present(frames[i],'duration_time'),
-                        'pkt_dts_time': check_value_is_present(frames[i],'pkt_dts_time'),
-                        'pkt_pos': frames[i]['pkt_pos'],
-                        'type': frames[i]['pict_type'],
-                        'key_frame': check_value_is_present(frames[i],'key_frame')
-                    }
-                    video_frames_small.append(dict_obj) 
-                    video_frames.append(frames[i])
-                if frames[i]["media_type"] == "audio":
-                    dict_obj = {
-                        'frame_index': i,
-                        'size_bytes': int(frames[i]['pkt_size']),
-                        'duration_time': check_value_is_present(frames[i],'duration_time'),
-                        'pkt_dts_time': check_value_is_present(frames[i],'pkt_dts_time')
-                        #'pkt_pos': frames[i]['pkt_pos']
-                    }
-                    audio_frames_small.append(dict_obj) 
-                    audio_frames.append(frames[i]) 
-
-            # Extract audio stream information
-            audio_streams = [stream for stream in ffprobe_output['streams'] if stream['codec_type'] == 'audio']
-            if audio_streams:
-                audio_video_tag='audio'
-                audio_stream = audio_streams[0]  # Assuming only one audio stream
-                dict_audio=audio_stream
-
-            else:
-                dict_audio={}
-            
-            if len(video_frames_small) == 0:
-                gop_structure_dict=[]
-            results={
-               "video": dict_video,
-               "videoFrames": video_frames_small,
-               "audio": dict_audio,
-               "audioFrames": audio_frames_small,
-               "format":ffprobe_output['format'],
-               "gopStructure": gop_structure_dict
-
-            }
-
-            return results
-        else:
+        try:
+            ffprobe_output = json.loads(result.stdout)
+        except ValueError:
+            ffprobe_output = {}
+        if not ffprobe_output.get('format'):
             print("ffprobe error - check is file is a media")
+            return None
+        streams = ffprobe_output.get('streams', [])
+        video_streams = [stream for stream in streams if stream['codec_type'] == 'video']
+        audio_streams = [stream for stream in streams if stream['codec_type'] == 'audio']
+        return {
+            "video": video_streams[0] if video_streams else {},
+            "audio": audio_streams[0] if audio_streams else {},
+            "format": ffprobe_output['format']
+        }
 
 #Class to Analyze DashManifest
 class DashManifestAnalyzer:
@@ -1,62 +1,252 @@
+import time
+import hashlib
 import json
 import boto3
-import uuid
 import os
-import urllib
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+import urllib.parse
 
-client = boto3.client('stepfunctions')
+client_config = Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+stepfunctions = boto3.client('stepfunctions', config=client_config)
+dynamodb = boto3.client('dynamodb', config=client_config)
+sqs = boto3.client('sqs', config=client_config)
 
-def lambda_handler(event, context):
-    # Generate UUID for this session
-    session_uuid = str(uuid.uuid4())
-    stepfunctions = boto3.client('stepfunctions')
-    s3_hostname = os.environ.get('CLOUDFRONT_HOSTNAME')
-    
-    # The ARN of the Step Function to execute
-    state_machine_arn = os.environ.get('STEP_FUNCTION_ARN')
-    record = event['Records'][0]
+# Number of start_execution calls running at the same time
+MAX_PARALLEL_STARTS = int(os.environ.get('MAX_PARALLEL_STARTS', 10))
+# Dedupe ledger: one item per bucket/key/ETag/preset, expired by the table TTL
+LEDGER_TABLE = os.environ.get('LEDGER_TABLE')
+LEDGER_TTL_SECONDS = int(os.environ.get('LEDGER_TTL_SECONDS', 7 * 24 * 3600))
+# An item still "starting" after this long belongs to an invocation that died before start_execution
+LEDGER_LEASE_SECONDS = 300
+# Admission control: jobs go to the bulk queue, the dispatcher starts them after the API jobs
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL')
+# Job status table: the job is recorded as submitted, ffmpeg-execute writes the next states
+JOBS_TABLE = os.environ.get('JOBS_TABLE')
+JOBS_TTL_SECONDS = 7 * 24 * 3600
+# "auto": ffmpeg-execute probes the upload and picks the preset (stream copy for sources at the target spec),
+# FFMPEG_COMMAND is only used if the probe fails. "fixed": FFMPEG_COMMAND for every upload
+PRESET = os.environ.get('PRESET', 'auto')
+FFMPEG_COMMAND = '-vf "deband=range=16:1thr=0.02:2thr=0.02:3thr=0.02" -c:v libx264 -preset ultrafast -crf 30 -pix_fmt yuv420p -profile:v high -x264-params "psy-rd=1.0:0.15:aq-mode=3:aq-strength=1.0:ref=4:bframes=3" -c:a:0 aac -b:a:0 96k {{output_files}}'
+
+def s3_records(event):
+    # Function to list the S3 records of the event with the SQS message they come from (None when invoked by S3)
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            # s3:TestEvent sent when the notification is created has no Records
+            for s3_record in body.get('Records', []):
+                yield s3_record, record['messageId']
+        else:
+            yield record, None
+
+def collect_uploads(event):
+    # Function to de-duplicate the uploads of the event on bucket/key/version
+    uploads = {}
+    for record, message_id in s3_records(event):
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+        # Without versioning, the ETag tells two uploads of the same key apart
+        version = record['s3']['object'].get('versionId') or record['s3']['object'].get('eTag', '')
+        upload = uploads.setdefault((bucket, key, version), {
+            'bucket': bucket,
+            'key': key,
+            'version': version,
+            'etag': record['s3']['object'].get('eTag', ''),
+            'message_ids': set()
+        })
+        if message_id:
+            upload['message_ids'].add(message_id)
+    return list(uploads.values())
+
+def execution_name(upload, ledger_entry=None):
+    # Same upload, same name: a redelivered event cannot start a second execution
+    identity = f"{upload['bucket']}/{upload['key']}/{upload['version']}"
+    if ledger_entry:
+        # One execution per ledger entry: the same content can be transcoded again once the entry expired
+        return f"{hashlib.sha256(ledger_entry['key'].encode()).hexdigest()[:48]}-{ledger_entry['created']}"
+    return hashlib.sha256(identity.encode()).hexdigest()[:64]
+
+def ledger_key(upload, ffmpeg_command):
+    # Function to build the dedupe key: same object content transcoded with the same preset
+    preset = hashlib.sha256(ffmpeg_command.encode()).hexdigest()[:16]
+    return f"{upload['bucket']}/{upload['key']}/{upload['etag']}/{preset}"
 
-    bucket = record['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(record['s3']['object']['key'])
-    base, video_id, filename = key.split("/")
+def claim_ledger(key):
+    # Function to claim the ledger entry of an upload with a conditional write
+    # Returns (entry, None) when claimed, (None, existing item) for a duplicate
+    now = int(time.time())
+    try:
+        dynamodb.put_item(
+            TableName=LEDGER_TABLE,
+            Item={
+                'ledger_key': {'S': key},
+                'status': {'S': 'starting'},
+                'created': {'N': str(now)},
+                'TTL': {'N': str(now + LEDGER_TTL_SECONDS)}
+            },
+            # TTL deletion runs up to days late: an expired item can be claimed again until it is removed
+            ConditionExpression='attribute_not_exists(ledger_key) OR #ttl < :now OR (#status = :starting AND created < :stale)',
+            ExpressionAttributeNames={'#status': 'status', '#ttl': 'TTL'},
+            ExpressionAttributeValues={
+                ':starting': {'S': 'starting'},
+                ':stale': {'N': str(now - LEDGER_LEASE_SECONDS)},
+                ':now': {'N': str(now)}
+            }
+        )
+        return {'key': key, 'created': now}, None
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        existing = dynamodb.get_item(TableName=LEDGER_TABLE, Key={'ledger_key': {'S': key}}, ConsistentRead=True)
+        return None, existing.get('Item', {})
+
+def complete_ledger(entry, execution_arn):
+    # Function to store the execution of a claimed ledger entry
+    dynamodb.update_item(
+        TableName=LEDGER_TABLE,
+        Key={'ledger_key': {'S': entry['key']}},
+        UpdateExpression='SET #status = :started, executionArn = :arn',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':started': {'S': 'started'}, ':arn': {'S': execution_arn}}
+    )
+
+def release_ledger(entry):
+    # Function to remove a claimed entry whose execution did not start, so a retry can claim it
+    dynamodb.delete_item(
+        TableName=LEDGER_TABLE,
+        Key={'ledger_key': {'S': entry['key']}},
+        ConditionExpression='#status = :starting AND created = :created',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':starting': {'S': 'starting'}, ':created': {'N': str(entry['created'])}}
+    )
+
+def record_job(job_id, video_id, execution_arn, status='submitted'):
+    # Function to write the submitted state of a job in the jobs table
+    if not JOBS_TABLE:
+        return
+    now = int(time.time())
+    try:
+        dynamodb.update_item(
+            TableName=JOBS_TABLE,
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression='SET #status = if_not_exists(#status, :status), video_id = :video_id, #mode = :mode, '
+                'executionArn = :arn, created_at = if_not_exists(created_at, :now), updated_at = if_not_exists(updated_at, :now), #ttl = :ttl',
+            ExpressionAttributeNames={'#status': 'status', '#mode': 'mode', '#ttl': 'TTL'},
+            ExpressionAttributeValues={
+                ':status': {'S': status},
+                ':video_id': {'S': video_id},
+                ':mode': {'S': 's3_event'},
+                ':arn': {'S': execution_arn},
+                ':now': {'N': str(now)},
+                ':ttl': {'N': str(now + JOBS_TTL_SECONDS)}
+            }
+        )
+    except Exception as e:
+        print(f"Error recording job {job_id}: {e}")
 
-    s3_url = f"s3://{bucket}/{key}"
-    print(s3_url)
+def start_job(upload, state_machine_arn, s3_hostname):
+    # Function to start the Step Function execution of an upload
+    key = upload['key']
+    parts = key.split("/")
+    if len(parts) != 3:
+        # Not retried: the key will never match import/<video_id>/<filename>
+        print(f"Skipping {key}: expected import/<video_id>/<filename>")
+        return {'key': key, 'status': 'skipped'}
+    base, video_id, filename = parts
 
-    # Convert string inputs to the object format expected by the ffmpeg function
-    # Prepend UUID to input files
-    input_file=s3_url
-    output_url = f"{s3_hostname}/ffmpeg/{video_id}/{filename}.mp4"
-    ffmpeg_command='-vf "deband=range=16:1thr=0.02:2thr=0.02:3thr=0.02" -c:v libx264 -preset ultrafast -crf 30 -pix_fmt yuv420p -profile:v high -x264-params "psy-rd=1.0:0.15:aq-mode=3:aq-strength=1.0:ref=4:bframes=3" -c:a:0 aac -b:a:0 96k {{output_files}}'
+    s3_url = f"s3://{upload['bucket']}/{key}"
     payload = {
-        "input_files": input_file,
+        "input_files": s3_url,
         "video_id": video_id,
         "output_files": {"output_files": f"{filename}.mp4"},
-        "ffmpeg_command": ffmpeg_command
+        "ffmpeg_command": FFMPEG_COMMAND
     }
-    print("payload",payload)
+    if PRESET == 'auto':
+        payload["preset"] = "auto"
+    ledger_entry = None
     try:
-        # Start the Step Function execution
-        response = stepfunctions.start_execution(
-            stateMachineArn=state_machine_arn,
-            input=json.dumps(payload)
-        )
-        print(f"Started execution: {response['executionArn']}")
-        
+        if LEDGER_TABLE:
+            ledger_entry, existing = claim_ledger(ledger_key(upload, f"{PRESET}:{FFMPEG_COMMAND}"))
+            if existing is not None:
+                execution_arn = existing.get('executionArn', {}).get('S')
+                print(f"Duplicate upload {s3_url}: {execution_arn or 'execution starting'}")
+                return {'key': key, 'status': 'duplicate', 'executionArn': execution_arn}
+
+        # The execution name identifies the job in the job status table
+        name = execution_name(upload, ledger_entry)
+        if JOB_QUEUE_URL:
+            # Started by the dispatcher with this name: the executionArn is known now
+            sqs.send_message(
+                QueueUrl=JOB_QUEUE_URL,
+                MessageBody=json.dumps({'stateMachineArn': state_machine_arn, 'name': name, 'input': {**payload, "job_id": name}})
+            )
+            response = {'executionArn': f"{state_machine_arn.replace(':stateMachine:', ':execution:')}:{name}"}
+            print(f"Queued execution: {response['executionArn']}")
+            record_job(name, video_id, response['executionArn'], status='queued')
+        else:
+            response = stepfunctions.start_execution(
+                stateMachineArn=state_machine_arn,
+                name=name,
+                input=json.dumps({**payload, "job_id": name})
+            )
+            print(f"Started execution: {response['executionArn']}")
+            record_job(name, video_id, response['executionArn'])
+        if ledger_entry:
+            try:
+                complete_ledger(ledger_entry, response['executionArn'])
+            except Exception as e:
+                # The execution is running: report it as started
+                print(f"Error updating ledger entry {ledger_entry['key']}: {str(e)}")
         return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'Step Function execution started successfully',
-                'executionArn': response['executionArn'],
-                #'session_uuid': session_uuid,
-                'input_files': input_file,
-                'output_files': output_url
-            })
+            'key': key,
+            'status': 'started',
+            'executionArn': response['executionArn'],
+            'output_files': f"{s3_hostname}/ffmpeg/{video_id}/{filename}.mp4"
         }
-        
+    except stepfunctions.exceptions.ExecutionAlreadyExists:
+        print(f"Execution already started for {s3_url}")
+        return {'key': key, 'status': 'duplicate'}
     except Exception as e:
-        print(f"Error: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
-        }
\ No newline at end of file
+        print(f"Error starting {s3_url}: {str(e)}")
+        if ledger_entry:
+            try:
+                release_ledger(ledger_entry)
+            except Exception as release_error:
+                # The lease lets a retry claim the entry anyway
+                print(f"Error releasing ledger entry {ledger_entry['key']}: {str(release_error)}")
+        return {'key': key, 'status': 'failed', 'error': str(e)}
+
+def lambda_handler(event, context):
+    s3_hostname = os.environ.get('CLOUDFRONT_HOSTNAME')
+
+    # The ARN of the Step Function to execute
+    state_machine_arn = os.environ.get('STEP_FUNCTION_ARN')
+    sqs_mode = any(record.get('eventSource') == 'aws:sqs' for record in event.get('Records', []))
+
+    uploads = collect_uploads(event)
+    print(f"{len(uploads)} uploads in {len(event.get('Records', []))} records")
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_STARTS) as executor:
+        results = list(executor.map(lambda upload: start_job(upload, state_machine_arn, s3_hostname), uploads))
+
+    failed = [upload for upload, result in zip(uploads, results) if result['status'] == 'failed']
+
+    if sqs_mode:
+        # Partial batch response: only the messages of the failed uploads go back to the queue
+        failed_messages = sorted({message_id for upload in failed for message_id in upload['message_ids']})
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_messages]}
+
+    if failed:
+        # Invoked by S3 (asynchronous): raising makes Lambda retry the event,
+        # executions already started are not started twice (same execution name)
+        raise Exception(f"{len(failed)} of {len(uploads)} executions failed to start")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Step Function executions started successfully',
+            'executions': results
+        })
+    }
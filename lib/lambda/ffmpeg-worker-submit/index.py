@@ -1,50 +1,361 @@
+import time
 import json
 import boto3
+import re
 import uuid
 import os
+import urllib.request
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
-client = boto3.client('stepfunctions')
+# Batch submission: start_execution calls running at the same time, jobs accepted per request
+MAX_PARALLEL_STARTS = int(os.environ.get('MAX_PARALLEL_STARTS', 16))
+MAX_BATCH_JOBS = int(os.environ.get('MAX_BATCH_JOBS', 1000))
+# API Gateway closes the connection after 29s: jobs not started by then are returned as not submitted
+BATCH_TIME_BUDGET = 25
+
+# Synchronous mode: ffmpeg-execute is invoked directly when the job is estimated to finish within SYNC_MAX_SECONDS
+EXECUTE_FUNCTION_NAME = os.environ.get('EXECUTE_FUNCTION_NAME')
+SYNC_MAX_SECONDS = float(os.environ.get('SYNC_MAX_SECONDS', 20))
+# Estimates: media seconds encoded per second, input bytes processed per second
+SYNC_ENCODE_SPEED = float(os.environ.get('SYNC_ENCODE_SPEED', 2))
+SYNC_BYTES_PER_SECOND = float(os.environ.get('SYNC_BYTES_PER_SECOND', 10 * 1024 * 1024))
+SINGLE_FRAME_PATTERN = re.compile(r"-(?:frames:v|vframes)\s+1\b")
+OUTPUT_DURATION_PATTERN = re.compile(r"(?:^|\s)-t\s+(\S+)")
+# ffmpeg durations: [-][HH:]MM:SS[.m...] or [-]S+[.m...][s|ms|us]
+DURATION_PATTERN = re.compile(r"(?:(?:(\d+):)?(\d+):(\d+(?:\.\d*)?))|(?:(\d+(?:\.\d*)?)(s|ms|us)?)")
+DURATION_UNITS = {'s': 1, 'ms': 1000, 'us': 1000000}
+
+# Admission control: async jobs are queued for the dispatcher, which starts them under the concurrency cap
+# Single jobs go to the interactive queue, batches to the bulk queue dispatched after it
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL')
+BULK_QUEUE_URL = os.environ.get('BULK_QUEUE_URL') or JOB_QUEUE_URL
+
+# Job status table: the job is recorded as submitted, ffmpeg-execute writes the next states
+JOBS_TABLE = os.environ.get('JOBS_TABLE')
+JOBS_TTL_SECONDS = 7 * 24 * 3600
+
+# Adaptive retries slow the client down when Step Functions throttles StartExecution
+stepfunctions = boto3.client('stepfunctions', config=Config(
+    retries={'max_attempts': 8, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    max_pool_connections=MAX_PARALLEL_STARTS
+))
+# Each synchronous invocation is a transcode: it is never retried, the read timeout covers the API limit
+lambda_client = boto3.client('lambda', config=Config(
+    retries={'total_max_attempts': 1},
+    read_timeout=60,
+    tcp_keepalive=True
+))
+s3_client = boto3.client('s3', config=Config(tcp_keepalive=True))
+sqs = boto3.client('sqs', config=Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    max_pool_connections=MAX_PARALLEL_STARTS
+))
+jobs_table = boto3.resource('dynamodb', config=Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True,
+    max_pool_connections=MAX_PARALLEL_STARTS
+)).Table(JOBS_TABLE) if JOBS_TABLE else None
+
+# Optional ffmpeg-execute settings passed through to the Step Function
+OPTIONAL_FIELDS = ['input_mode', 'output_mode', 'chunked', 'chunk_duration', 'checkpoint_margin', 'no_cache', 'ladder', 'ladder_format', 'ladder_audio_bitrate', 'expected_output_size', 'preset']
+
+def validate_job(job):
+    # Function to list what is wrong with a job, empty if it can be submitted
+    errors = []
+    if not isinstance(job, dict):
+        return ['job must be an object']
+    for field in ('stepFunction', 'input_files', 'video_id'):
+        if not job.get(field):
+            errors.append(f"{field} is required")
+    # ABR ladder jobs get their command and outputs from the rendition list
+    if not job.get('ladder'):
+        for field in ('output_files', 'ffmpeg_command'):
+            # With the adaptive preset, the command is chosen from the probe of the input
+            if not job.get(field) and not (field == 'ffmpeg_command' and job.get('preset') == 'auto'):
+                errors.append(f"{field} is required")
+    if job.get('preset') == 'auto' and isinstance(job.get('output_files'), dict) and len(job['output_files']) != 1:
+        errors.append("preset auto requires exactly one output file")
+    if job.get('preset') == 'auto' and job.get('output_mode') == 'stream':
+        errors.append("preset auto cannot be used with output_mode stream")
+    if job.get('chunked') and job.get('ladder'):
+        errors.append("chunked cannot be used with ladder")
+    return errors
+
+def build_payload(job, s3_hostname, job_id):
+    # Function to convert a submitted job to the ffmpeg-execute input
+    input_file = job["input_files"]
+    input_video_id = job["video_id"]
+    output_files = job.get("output_files", "")
+    # A single file name is the {{output_files}} placeholder, a dict already maps placeholders to file names
+    if isinstance(output_files, dict):
+        output_urls = {key: f"{s3_hostname}/ffmpeg/{input_video_id}/{filename}" for key, filename in output_files.items()}
+    else:
+        output_files = {"output_files": output_files} if output_files else {}
+        output_urls = f"{s3_hostname}/ffmpeg/{input_video_id}/{job.get('output_files', '')}"
+
+    payload = {
+        "job_id": job_id,
+        "input_files": input_file,
+        "video_id": input_video_id,
+        "output_files": output_files,
+        "ffmpeg_command": job.get("ffmpeg_command", "")
+    }
+    # Forward the optional execution settings
+    for option in OPTIONAL_FIELDS:
+        if option in job:
+            payload[option] = job[option]
+    return payload, output_urls
+
+def record_job(job_id, video_id, mode, execution_arn=None, status='submitted'):
+    # Function to write the submitted state of a job (or its executionArn once started) in the jobs table
+    if jobs_table is None:
+        return
+    now = int(time.time())
+    try:
+        if execution_arn:
+            jobs_table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='SET executionArn = :arn',
+                ExpressionAttributeValues={':arn': execution_arn}
+            )
+            return
+        jobs_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET #status = :status, video_id = :video_id, #mode = :mode, created_at = :now, updated_at = :now, #ttl = :ttl',
+            ExpressionAttributeNames={'#status': 'status', '#mode': 'mode', '#ttl': 'TTL'},
+            ExpressionAttributeValues={
+                ':status': status,
+                ':video_id': video_id,
+                ':mode': mode,
+                ':now': now,
+                ':ttl': now + JOBS_TTL_SECONDS
+            }
+        )
+    except Exception as e:
+        print(f"Error recording job {job_id}: {e}")
+
+def input_size(url):
+    # Function to get the size of an input with a HEAD request, None if unknown
+    try:
+        if url.startswith('s3://'):
+            parsed_s3 = urlparse(url)
+            return s3_client.head_object(Bucket=parsed_s3.netloc, Key=parsed_s3.path.lstrip('/'))['ContentLength']
+        if url.startswith(('http://', 'https://')):
+            request = urllib.request.Request(url, method='HEAD')
+            with urllib.request.urlopen(request, timeout=2) as response:
+                size = response.headers.get('Content-Length')
+                return int(size) if size else None
+    except Exception as e:
+        print(f"HEAD request failed for {url}: {e}")
+    return None
+
+def parse_duration(value):
+    # Function to convert an ffmpeg duration to seconds, None if it cannot be parsed (or is negative)
+    match = DURATION_PATTERN.fullmatch(value.strip('"\''))
+    if not match:
+        return None
+    hours, minutes, seconds, number, unit = match.groups()
+    if number is None:
+        return int(hours or 0) * 3600 + int(minutes) * 60 + float(seconds)
+    return float(number) / DURATION_UNITS[unit or 's']
+
+def estimate_duration(job):
+    # Function to estimate how long ffmpeg-execute takes for a job (seconds), None if unknown
+    if 'estimated_duration' in job:
+        return float(job['estimated_duration'])
+    command = job.get('ffmpeg_command', '')
+    # Thumbnail: a single frame is decoded and encoded
+    if SINGLE_FRAME_PATTERN.search(command):
+        return 1.0
+    # Clip: the output duration is set in the command
+    output_duration = OUTPUT_DURATION_PATTERN.search(command)
+    if output_duration:
+        seconds = parse_duration(output_duration.group(1))
+        return seconds / SYNC_ENCODE_SPEED if seconds is not None else None
+    # Otherwise: from the size of the inputs
+    inputs = job['input_files']
+    urls = list(inputs.values()) if isinstance(inputs, dict) else [inputs]
+    sizes = [input_size(url) for url in urls]
+    if None in sizes:
+        return None
+    return sum(sizes) / SYNC_BYTES_PER_SECOND
+
+def sync_route(job):
+    # Function to decide if a job asking for the synchronous mode can run in it, with the reason
+    if not EXECUTE_FUNCTION_NAME:
+        return False, 'synchronous mode is not configured'
+    if job.get('chunked') or job.get('ladder'):
+        return False, 'chunked and ladder jobs run asynchronously'
+    estimate = estimate_duration(job)
+    if estimate is None:
+        return False, 'duration could not be estimated'
+    if estimate > SYNC_MAX_SECONDS:
+        return False, f'estimated duration {estimate:.1f}s over {SYNC_MAX_SECONDS:.0f}s'
+    return True, f'estimated duration {estimate:.1f}s'
+
+def run_sync(payload):
+    # Function to run the job in ffmpeg-execute and wait for its result
+    response = lambda_client.invoke(
+        FunctionName=EXECUTE_FUNCTION_NAME,
+        InvocationType='RequestResponse',
+        Payload=json.dumps(payload)
+    )
+    result = json.loads(response['Payload'].read())
+    if 'FunctionError' in response:
+        return {'statusCode': 500, 'body': result}
+    return result
+
+def start_job(job_id, video_id, state_machine_arn, payload, queue_url=JOB_QUEUE_URL):
+    # Function to start the execution of a job, or to queue it in queue_url when admission control is on
+    # Returns the executionArn and the status of the job
+    if not queue_url:
+        record_job(job_id, video_id, 'async')
+        response = stepfunctions.start_execution(
+            stateMachineArn=state_machine_arn,
+            input=json.dumps(payload)
+        )
+        record_job(job_id, video_id, 'async', response['executionArn'])
+        return response['executionArn'], 'started'
+
+    # The dispatcher starts the execution of this state machine with the job_id as name: its ARN is known now
+    execution_arn = f"{state_machine_arn.replace(':stateMachine:', ':execution:')}:{job_id}"
+    record_job(job_id, video_id, 'async', status='queued')
+    sqs.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps({'stateMachineArn': state_machine_arn, 'name': job_id, 'input': payload})
+    )
+    record_job(job_id, video_id, 'async', execution_arn)
+    return execution_arn, 'queued'
+
+def submit_job(index, job, s3_hostname, deadline):
+    # Function to start the execution of one job of a batch
+    if time.time() > deadline:
+        return {'index': index, 'status': 'not_submitted'}
+    job_id = str(uuid.uuid4())
+    payload, output_url = build_payload(job, s3_hostname, job_id)
+    try:
+        execution_arn, status = start_job(job_id, job["video_id"], job["stepFunction"], payload, BULK_QUEUE_URL)
+        return {
+            'index': index,
+            'job_id': job_id,
+            'status': status,
+            'executionArn': execution_arn,
+            'output_files': output_url
+        }
+    except Exception as e:
+        print(f"Error starting job {index}: {str(e)}")
+        return {'index': index, 'status': 'failed', 'error': str(e)}
+
+def submit_batch(event, s3_hostname):
+    # Function to validate every job of the batch, then start them in parallel
+    jobs = event["jobs"]
+    if not isinstance(jobs, list) or not jobs:
+        return {'statusCode': 400, 'body': json.dumps({'error': 'jobs must be a non-empty list'})}
+    if len(jobs) > MAX_BATCH_JOBS:
+        return {'statusCode': 400, 'body': json.dumps({'error': f'At most {MAX_BATCH_JOBS} jobs per request'})}
+
+    # Fields set at the batch level (stepFunction, ffmpeg_command...) apply to every job
+    defaults = {key: value for key, value in event.items() if key != 'jobs'}
+    jobs = [{**defaults, **job} if isinstance(job, dict) else job for job in jobs]
+
+    # Nothing is started if one job is invalid
+    errors = [{'index': index, 'errors': validate_job(job)} for index, job in enumerate(jobs)]
+    errors = [error for error in errors if error['errors']]
+    if errors:
+        return {'statusCode': 400, 'body': json.dumps({'error': 'Invalid jobs', 'jobs': errors})}
+
+    deadline = time.time() + BATCH_TIME_BUDGET
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_STARTS) as executor:
+        results = list(executor.map(lambda args: submit_job(*args, s3_hostname, deadline), enumerate(jobs)))
+
+    summary = {status: sum(1 for result in results if result['status'] == status) for status in ('started', 'queued', 'failed', 'not_submitted')}
+    print(f"Batch of {len(jobs)} jobs: {summary}")
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Batch submitted',
+            'summary': summary,
+            'jobs': results
+        })
+    }
 
 def lambda_handler(event, context):
     # Generate UUID for this session
     session_uuid = str(uuid.uuid4())
-    stepfunctions = boto3.client('stepfunctions')
     s3_hostname = os.environ.get('CLOUDFRONT_HOSTNAME')
-    
+
+    # Batch submission: {"jobs": [...]}
+    if "jobs" in event:
+        return submit_batch(event, s3_hostname)
+
     # The ARN of the Step Function to execute
     state_machine_arn = event["stepFunction"]
-    
+
     # Convert string inputs to the object format expected by the ffmpeg function
     # Prepend UUID to input files
     input_file=event["input_files"]
     input_video_id = event["video_id"]
-    
-    input_with_uuid = f"{s3_hostname}/{input_video_id}/{event['input_files']}"
-    output_with_uuid = f"{s3_hostname}/ffmpeg/{input_video_id}/{event['output_files']}"
-    
-    payload = {
-        "input_files": input_file,
-        "video_id": input_video_id,
-        "output_files": {"output_files": event["output_files"]},
-        "ffmpeg_command": event["ffmpeg_command"]
-    }
-    
+    payload, output_with_uuid = build_payload(event, s3_hostname, session_uuid)
+
+    # Synchronous mode: short jobs return their output URLs in the response, the others go to the Step Function
+    mode_reason = None
+    if event.get("sync"):
+        run_now, mode_reason = sync_route(event)
+        print(f"Synchronous mode: {run_now} ({mode_reason})")
+        if run_now:
+            record_job(session_uuid, input_video_id, 'sync')
+            try:
+                result = run_sync(payload)
+            except lambda_client.exceptions.TooManyRequestsException:
+                # ffmpeg-execute is at its reserved concurrency: the job is queued instead
+                result = None
+                mode_reason = 'concurrency cap reached'
+                print(f"Synchronous mode: False ({mode_reason})")
+            except Exception as e:
+                print(f"Error: {str(e)}")
+                return {
+                    'statusCode': 500,
+                    'body': json.dumps({'error': str(e)})
+                }
+            if result is not None:
+                body = result.get('body')
+                if result.get('statusCode') != 200:
+                    return {
+                        'statusCode': result.get('statusCode', 500),
+                        'body': json.dumps({'error': body})
+                    }
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({
+                        'message': 'FFmpeg job completed',
+                        'mode': 'sync',
+                        'session_uuid': session_uuid,
+                        'job_id': session_uuid,
+                        'input_files': input_file,
+                        'output_files': body['output_files'],
+                        'timings': body.get('timings')
+                    })
+                }
+
     try:
         # Start the Step Function execution
-        response = stepfunctions.start_execution(
-            stateMachineArn=state_machine_arn,
-            input=json.dumps(payload)
-        )
-        print(f"Started execution: {response['executionArn']}")
-        
+        execution_arn, status = start_job(session_uuid, input_video_id, state_machine_arn, payload)
+        print(f"Execution {status}: {execution_arn}")
+
         return {
             'statusCode': 200,
             'body': json.dumps({
-                'message': 'Step Function execution started successfully',
-                'executionArn': response['executionArn'],
+                'message': 'Step Function execution started successfully' if status == 'started' else 'Job queued',
+                'executionArn': execution_arn,
                 'session_uuid': session_uuid,
+                'job_id': session_uuid,
                 'input_files': input_file,
-                'output_files': output_with_uuid
+                'output_files': output_with_uuid,
+                **({'mode': 'async', 'reason': mode_reason} if mode_reason else {})
             })
         }
     except Exception as e:
@@ -52,4 +363,4 @@ def lambda_handler(event, context):
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
-        }
\ No newline at end of file
+        }
@@ -3,6 +3,9 @@ import * as lambda from 'aws-cdk-lib/aws-lambda';
 import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as s3n from 'aws-cdk-lib/aws-s3-notifications';
 import * as iam from 'aws-cdk-lib/aws-iam';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
+import * as lambdaEventSources from 'aws-cdk-lib/aws-lambda-event-sources';
 import { Construct } from 'constructs';
 
 export interface S3EventLambdaProps {
@@ -12,10 +15,21 @@ export interface S3EventLambdaProps {
   environment?: { [key: string]: string };
   timeout?: cdk.Duration;
   memorySize?: number;
+  // SQS-buffered mode: S3 events go to a queue and are read in batches
+  queueBuffered?: boolean;
+  batchSize?: number;
+  maxBatchingWindow?: cdk.Duration;
+  // Maximum number of concurrent function instances reading the queue
+  maxConcurrency?: number;
+  // Dedupe ledger: a duplicate delivery or re-upload of the same content does not start a new job
+  dedupeLedger?: boolean;
+  ledgerTtl?: cdk.Duration;
 }
 
 export class S3EventLambda extends Construct {
   public readonly lambdaFunction: lambda.Function;
+  public readonly queue?: sqs.Queue;
+  public readonly ledgerTable?: dynamodb.Table;
 
   constructor(scope: Construct, id: string, props: S3EventLambdaProps) {
     super(scope, id);
@@ -35,6 +49,26 @@ export class S3EventLambda extends Construct {
     // Grant the Lambda function permissions to read from S3
     props.s3Bucket.grantRead(this.lambdaFunction);
 
+    if (props.dedupeLedger) {
+      // One item per bucket/key/ETag/preset, written with a conditional put
+      // On-demand capacity: bulk ingests write thousands of items in a few seconds
+      this.ledgerTable = new dynamodb.Table(this, "LedgerTable", {
+        partitionKey: {
+          name: "ledger_key",
+          type: dynamodb.AttributeType.STRING,
+        },
+        billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+        removalPolicy: cdk.RemovalPolicy.DESTROY, // Use with caution in production
+        timeToLiveAttribute: "TTL",
+      });
+      this.ledgerTable.grantReadWriteData(this.lambdaFunction);
+      this.lambdaFunction.addEnvironment("LEDGER_TABLE", this.ledgerTable.tableName);
+      this.lambdaFunction.addEnvironment(
+        "LEDGER_TTL_SECONDS",
+        String((props.ledgerTtl || cdk.Duration.days(7)).toSeconds())
+      );
+    }
+
     // Add Step Functions permissions
     this.lambdaFunction.addToRolePolicy(
       new iam.PolicyStatement({
@@ -59,11 +93,44 @@ export class S3EventLambda extends Construct {
       })
     );
 
-    // Add S3 event notification with 'import' prefix filter
+    if (!props.queueBuffered) {
+      // Add S3 event notification with 'import' prefix filter
+      props.s3Bucket.addEventNotification(
+        s3.EventType.OBJECT_CREATED,
+        new s3n.LambdaDestination(this.lambdaFunction),
+        { prefix: 'import' }
+      );
+      return;
+    }
+
+    // SQS-buffered mode: bursts of uploads are read as a few large batches,
+    // messages that keep failing end in the dead-letter queue
+    const deadLetterQueue = new sqs.Queue(this, "S3EventDeadLetterQueue", {
+      retentionPeriod: cdk.Duration.days(14),
+    });
+    this.queue = new sqs.Queue(this, "S3EventQueue", {
+      // At least 6 times the function timeout, as recommended for SQS event sources
+      visibilityTimeout: cdk.Duration.seconds((props.timeout || cdk.Duration.seconds(60)).toSeconds() * 6),
+      deadLetterQueue: {
+        queue: deadLetterQueue,
+        maxReceiveCount: 5,
+      },
+    });
+
     props.s3Bucket.addEventNotification(
       s3.EventType.OBJECT_CREATED,
-      new s3n.LambdaDestination(this.lambdaFunction),
+      new s3n.SqsDestination(this.queue),
       { prefix: 'import' }
     );
+
+    // The function reports the failed messages only (partial batch response)
+    this.lambdaFunction.addEventSource(
+      new lambdaEventSources.SqsEventSource(this.queue, {
+        batchSize: props.batchSize || 100,
+        maxBatchingWindow: props.maxBatchingWindow || cdk.Duration.seconds(20),
+        maxConcurrency: props.maxConcurrency || 5,
+        reportBatchItemFailures: true,
+      })
+    );
   }
 }
\ No newline at end of file
@@ -13,10 +13,14 @@ import {
 interface stepFunctionWorkerConstructProps {
   readonly s3BucketOutput: s3.Bucket;
   readonly cloudFrontOutput: cloudfront.Distribution;
+  // ffmpeg-execute invocations running at the same time (reserved concurrency), whatever starts them
+  readonly maxConcurrentInvocations?: number;
 }
 
 export class stepFunctionWorker extends Construct {
   public readonly stepFunctionOutput: sfn.StateMachine;
+  // ffmpeg-execute, also invoked directly for synchronous jobs
+  public readonly executeFunctionOutput: lambda.Function;
   constructor(scope: Construct, id: string, props:stepFunctionWorkerConstructProps) {
     super(scope, id);
 
@@ -45,6 +49,8 @@ export class stepFunctionWorker extends Construct {
       runtime: lambda.Runtime.PYTHON_3_13,
       handler: "index.lambda_handler",
       code: lambda.Code.fromAsset(submitLambdaPath),
+      // Hard cap: chunk encodes, Step Function jobs and synchronous jobs all count
+      reservedConcurrentExecutions: props.maxConcurrentInvocations,
       environment: {
         CLOUDFRONT_HOSTNAME: "https://"+props.cloudFrontOutput.domainName,
         BUCKET_NAME: props.s3BucketOutput.bucketName,
@@ -59,12 +65,14 @@ export class stepFunctionWorker extends Construct {
     //Grant permission
 
     const ffmpegS3Policy = new iam.PolicyStatement({
-      actions: ["s3:GetObject", "s3:PutObject", "s3:PutObjectAcl"],
+      actions: ["s3:GetObject", "s3:PutObject", "s3:PutObjectAcl", "s3:DeleteObject"],
       resources: [props.s3BucketOutput.arnForObjects("*")], // You can scope it down to specific log groups if needed
     });
     // Attach the policy to the Lambda function
     submitLambda.addToRolePolicy(ffmpegS3Policy);
 
+    this.executeFunctionOutput = submitLambda;
+
     new cdk.CfnOutput(this, "LambdaArn", {
       value: submitLambda.functionArn,
       description: "The Lambda function ARN",
@@ -72,11 +80,22 @@ export class stepFunctionWorker extends Construct {
 
     /** ------------------ Step functions Definition ------------------ */
 
+    // Invocations over the reserved concurrency are throttled: the task waits and tries again
+    const retryThrottled = (task: tasks.LambdaInvoke) =>
+      task.addRetry({
+        errors: ["Lambda.TooManyRequestsException"],
+        interval: cdk.Duration.seconds(10),
+        backoffRate: 2,
+        maxAttempts: 10,
+        maxDelay: cdk.Duration.minutes(5),
+      });
+
     const submitJob = new tasks.LambdaInvoke(this, "Submit Job", {
       lambdaFunction: submitLambda,
       // Lambda's result is in the attribute `Payload`
       outputPath: "$.Payload",
     });
+    retryThrottled(submitJob);
 
     const jobFailed = new sfn.Fail(this, "Job Failed", {
       cause: "AWS Batch Job Failed",
@@ -84,13 +103,79 @@ export class stepFunctionWorker extends Construct {
     });
     const jobSucceeded = new sfn.Succeed(this, "Job Succeeded");
 
-    // Create chain
-    const definition = submitJob.next(
-      new sfn.Choice(this, "Job Complete?")
+    // A job stopped before the Lambda timeout returns 202 and its checkpoint: start a new invocation
+    const resumeJob = new sfn.Pass(this, "Resume Job", {
+      inputPath: "$.body.job",
+    });
+
+    const jobComplete = new sfn.Choice(this, "Job Complete?")
+      .when(sfn.Condition.numberEquals("$.statusCode", 202), resumeJob.next(submitJob))
+      .when(sfn.Condition.numberGreaterThan("$.statusCode", 200), jobFailed)
+      .when(sfn.Condition.numberEquals("$.statusCode", 200), jobSucceeded);
+
+    /** ------------------ Chunked mode: plan, encode chunks in parallel, stitch ------------------ */
+
+    const planChunks = new tasks.LambdaInvoke(this, "Plan Chunks", {
+      lambdaFunction: submitLambda,
+      payload: sfn.TaskInput.fromObject({
+        action: "plan",
+        "job.$": "$",
+      }),
+      outputPath: "$.Payload",
+    });
+    retryThrottled(planChunks);
+
+    const encodeChunk = new tasks.LambdaInvoke(this, "Encode Chunk", {
+      lambdaFunction: submitLambda,
+      payload: sfn.TaskInput.fromObject({
+        action: "encode_chunk",
+        "job.$": "$.job",
+        "chunk.$": "$.chunk",
+      }),
+      outputPath: "$.Payload",
+    });
+    retryThrottled(encodeChunk);
+
+    const encodeChunks = new sfn.Map(this, "Encode Chunks", {
+      itemsPath: sfn.JsonPath.stringAt("$.body.chunks"),
+      itemSelector: {
+        "job.$": "$.body.job",
+        "chunk.$": "$$.Map.Item.Value",
+      },
+      // A chunked job never takes more than the invocation cap
+      maxConcurrency: Math.min(20, props.maxConcurrentInvocations ?? 20),
+      resultPath: "$.chunkResults",
+    });
+    encodeChunks.itemProcessor(encodeChunk);
+
+    const stitchChunks = new tasks.LambdaInvoke(this, "Stitch Chunks", {
+      lambdaFunction: submitLambda,
+      payload: sfn.TaskInput.fromObject({
+        action: "stitch",
+        "job.$": "$.body.job",
+        "chunks.$": "$.chunkResults",
+      }),
+      outputPath: "$.Payload",
+    });
+    retryThrottled(stitchChunks);
+
+    const chunkedJob = planChunks.next(
+      new sfn.Choice(this, "Plan Complete?")
         .when(sfn.Condition.numberGreaterThan("$.statusCode", 200), jobFailed)
-        .when(sfn.Condition.numberEquals("$.statusCode", 200), jobSucceeded)
+        .otherwise(encodeChunks.next(stitchChunks).next(jobComplete))
     );
 
+    // Create chain
+    const definition = new sfn.Choice(this, "Chunked Job?")
+      .when(
+        sfn.Condition.and(
+          sfn.Condition.isPresent("$.chunked"),
+          sfn.Condition.booleanEquals("$.chunked", true)
+        ),
+        chunkedJob
+      )
+      .otherwise(submitJob.next(jobComplete));
+
     // Create state machine
     this.stepFunctionOutput = new sfn.StateMachine(
       this,
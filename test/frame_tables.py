@@ -0,0 +1,20 @@
+from videotools_functions import FrameTable
+
+# 32 fps: frame times are exact in binary floating point
+FPS = 32
+
+
+def frame_table(frames):
+    # Build a FrameTable from (pict_type, size in bytes) tuples, one frame every 1/FPS second
+    table = FrameTable()
+    for index, (pict_type, size) in enumerate(frames):
+        table.append(index, {
+            'pict_type': pict_type.upper(),
+            'key_frame': '1' if pict_type == 'I' else '0',
+            'pkt_size': str(size),
+            'pkt_pos': str(index),
+            'pkt_dts_time': str(index / FPS),
+            'pts_time': str(index / FPS),
+            'duration_time': str(1 / FPS)
+        })
+    return table
@@ -0,0 +1,21 @@
+import importlib.util
+import os
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), "..", "lib", "lambda")
+
+
+def load_lambda(function_name):
+    # Import lib/lambda/<function_name>/index.py under its own module name: every handler file is index.py
+    directory = os.path.join(LAMBDA_DIR, function_name)
+    # The clients are created at import time, no call is made to AWS
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    module_name = function_name.replace('-', '_')
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(directory, "index.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[module_name] = module
+    return sys.modules[module_name]
@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from lambda_modules import load_lambda
+
+auth = load_lambda("ffmpeg-auth")
+
+
+class StageResourceTest(unittest.TestCase):
+
+    def test_stage_resource(self):
+        method_arn = "arn:aws:execute-api:eu-west-1:123456789012:abcdef1234/prod/POST/ffmpeg/submit"
+        self.assertEqual(auth.stage_resource(method_arn), "arn:aws:execute-api:eu-west-1:123456789012:abcdef1234/prod/*")
+
+    def test_key_context(self):
+        item = {'tenant': {'S': 'acme'}, 'priority': {'S': 'bulk'}, 'quota': {'N': '1000'}}
+        self.assertEqual(auth.key_context(item), {'tenant': 'acme', 'priority': 'bulk', 'quota': 1000})
+        self.assertEqual(auth.key_context({}), {'tenant': '', 'priority': 'interactive', 'quota': 0})
+
+
+class LookupKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stubber = Stubber(auth.dynamodb)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        for patcher in (mock.patch.object(auth, 'API_KEYS_TABLE', 'api-keys'),
+                        mock.patch.object(auth, 'KEY_CACHE_MAX_ENTRIES', 2),
+                        mock.patch.dict(auth.key_cache, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_cached_lookups(self):
+        item = {'key_hash': {'S': 'known'}, 'tenant': {'S': 'acme'}}
+        self.stubber.add_response('get_item', {'Item': item}, {'TableName': 'api-keys', 'Key': {'key_hash': {'S': 'known'}}})
+        self.stubber.add_response('get_item', {}, {'TableName': 'api-keys', 'Key': {'key_hash': {'S': 'unknown'}}})
+        for _ in range(2):
+            self.assertEqual(auth.lookup_key('known'), item)
+            self.assertIsNone(auth.lookup_key('unknown'))
+        self.stubber.assert_no_pending_responses()
+
+    def test_cache_is_bounded(self):
+        for key_hash in ('a', 'b', 'c'):
+            self.stubber.add_response('get_item', {})
+            auth.lookup_key(key_hash)
+        # Least recently used first out
+        self.assertEqual(list(auth.key_cache), ['b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "lambda", "ffmpeg-execute"))
+
+from videotools_functions import FrameTable
+from frame_tables import FPS, frame_table
+
+
+class BitrateTimelineTest(unittest.TestCase):
+
+    def test_per_second_sums(self):
+        table = frame_table([('P', 1000)] * FPS + [('P', 2000)] * FPS)
+        timeline = table.bitrate_timeline()
+        # 32 frames x 1000 bytes = 256 kbit in the first second, twice as much in the second
+        self.assertEqual(timeline['perSecondKbps'], [256.0, 512.0])
+        self.assertEqual(timeline['duration'], 2.0)
+        self.assertEqual(timeline['averageKbps'], 384.0)
+
+    def test_peak_window(self):
+        frames = [('P', 1000)] * (3 * FPS)
+        frames[FPS] = ('P', 50000)
+        timeline = frame_table(frames).bitrate_timeline(window=1.0)
+        # Windows starting after 0 and up to 1s hold the large frame and 31 others
+        self.assertEqual(timeline['peakKbps'], (31 * 1000 + 50000) * 8 / 1000)
+        self.assertEqual(timeline['peakTime'], round(1 / FPS, 3))
+        self.assertEqual(timeline['window'], 1.0)
+
+    def test_gop_bitrate(self):
+        table = frame_table(([('I', 4000)] + [('P', 1000)] * (FPS - 1)) * 2)
+        # One GOP per second: 4000 + 31 x 1000 bytes
+        self.assertEqual(table.bitrate_timeline()['gopKbps'], [280.0, 280.0])
+
+    def test_empty_table(self):
+        self.assertEqual(FrameTable().bitrate_timeline(), {})
+
+
+class VbvCheckTest(unittest.TestCase):
+
+    def test_underflow(self):
+        # 100 kbit buffer starting 90% full: the 100 kbit frame at 0s is 10 kbit short
+        table = FrameTable()
+        for index, (time, size) in enumerate([(0.0, 12500), (1.0, 1000)]):
+            table.append(index, {'pict_type': 'I', 'key_frame': '1', 'pkt_size': str(size), 'pkt_dts_time': str(time)})
+        vbv = table.vbv_check(maxrate_kbps=100, bufsize_kbit=100)
+        self.assertFalse(vbv['compliant'])
+        self.assertEqual(vbv['underflows'], 1)
+        self.assertEqual(vbv['violations'], [{'time': 0.0, 'deficitBits': 10000}])
+        self.assertEqual(vbv['minFillPercent'], 0.0)
+        # Refilled to 100 kbit in 1s, then the 8 kbit frame is removed
+        self.assertEqual(vbv['fillTimeline'], [0.0, 92.0])
+
+    def test_empty_buffer_is_not_an_underflow(self):
+        table = FrameTable()
+        table.append(0, {'pict_type': 'I', 'key_frame': '1', 'pkt_size': '11250', 'pkt_dts_time': '0'})
+        vbv = table.vbv_check(maxrate_kbps=100, bufsize_kbit=100)
+        self.assertTrue(vbv['compliant'])
+        self.assertEqual(vbv['underflows'], 0)
+
+    def test_constant_rate_is_compliant(self):
+        # 256 kbit/s stream checked at 300 kbit/s
+        vbv = frame_table([('P', 1000)] * (4 * FPS)).vbv_check(maxrate_kbps=300, bufsize_kbit=300)
+        self.assertTrue(vbv['compliant'])
+        self.assertEqual(len(vbv['fillTimeline']), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from lambda_modules import load_lambda
+
+ffmpeg_execute = load_lambda("ffmpeg-execute")
+
+
+class ApplyThreadingTest(unittest.TestCase):
+
+    def test_default_threads(self):
+        global_args, cmd = ffmpeg_execute.apply_threading("-c:v libvpx-vp9 {{out}}", 6)
+        self.assertEqual(global_args, "-filter_threads 6 ")
+        self.assertEqual(cmd, "-threads 6 -c:v libvpx-vp9 {{out}}")
+
+    def test_filter_complex_threads(self):
+        global_args, _ = ffmpeg_execute.apply_threading('-filter_complex "[0:v]split=2[a][b]" {{out}}', 4)
+        self.assertEqual(global_args, "-filter_threads 4 -filter_complex_threads 4 ")
+
+    def test_x264_threads(self):
+        _, cmd = ffmpeg_execute.apply_threading("-c:v libx264 {{out}}", 6)
+        self.assertEqual(cmd, "-x264-params threads=6:lookahead-threads=3 -threads 6 -c:v libx264 {{out}}")
+
+    def test_x264_params_are_extended(self):
+        _, cmd = ffmpeg_execute.apply_threading('-c:v libx264 -x264-params "ref=4:bframes=3" {{out}}', 2)
+        self.assertIn('-x264-params "ref=4:bframes=3:threads=2:lookahead-threads=1"', cmd)
+
+    def test_caller_settings_are_kept(self):
+        command = "-filter_threads 1 -c:v libx264 -threads 2 {{out}}"
+        global_args, cmd = ffmpeg_execute.apply_threading(command, 6)
+        self.assertEqual(global_args, "")
+        self.assertEqual(cmd, command)
+
+
+class SplitAtKeyframesTest(unittest.TestCase):
+
+    def test_cut_on_next_keyframe(self):
+        # Keyframe every 2s, 5s chunks: each cut is on the first keyframe at least 5s after the chunk start
+        chunks = ffmpeg_execute.split_at_keyframes([0.0, 2.0, 4.0, 6.0, 8.0, 10.0, 12.0, 14.0], 5)
+        self.assertEqual(chunks, [
+            {'index': 0, 'start': 0.0, 'end': 6.0},
+            {'index': 1, 'start': 6.0, 'end': 12.0},
+            {'index': 2, 'start': 12.0, 'end': None}
+        ])
+
+    def test_short_input_is_one_chunk(self):
+        self.assertEqual(ffmpeg_execute.split_at_keyframes([0.0, 2.0], 60), [{'index': 0, 'start': 0.0, 'end': None}])
+
+    def test_no_keyframes(self):
+        self.assertEqual(ffmpeg_execute.split_at_keyframes([], 60), [{'index': 0, 'start': 0.0, 'end': None}])
+
+
+class BuildLadderCommandTest(unittest.TestCase):
+
+    LADDER = [
+        {'name': '720p', 'height': 720, 'video_bitrate': '3000k'},
+        {'height': 360, 'width': 640, 'video_bitrate': '1M', 'maxrate': '1200k'}
+    ]
+
+    def test_hls(self):
+        cmd, output_files = ffmpeg_execute.build_ladder_command(self.LADDER, 'hls', True, '128k')
+        self.assertEqual(output_files, {'master': 'master.m3u8'})
+        # One decode split into every rendition
+        self.assertIn('-filter_complex "[0:v]split=2[s0][s1];[s0]scale=-2:720[v0];[s1]scale=640:360[v1]"', cmd)
+        # maxrate and bufsize default to 1.1x and 2x the bitrate
+        self.assertIn("-b:v:0 3000k -maxrate:v:0 3300k -bufsize:v:0 6000k", cmd)
+        self.assertIn("-b:v:1 1M -maxrate:v:1 1200k -bufsize:v:1 2000k", cmd)
+        self.assertIn('-force_key_frames "expr:gte(t,n_forced*6)" -sc_threshold 0', cmd)
+        self.assertIn("-map 0:a:0 -c:a aac -b:a 128k", cmd)
+        self.assertIn('-var_stream_map "v:0,agroup:audio,name:720p v:1,agroup:audio,name:360p a:0,agroup:audio,name:audio"', cmd)
+        self.assertTrue(cmd.endswith("{{session_folder}}/%v.m3u8"))
+
+    def test_dash_without_audio(self):
+        cmd, output_files = ffmpeg_execute.build_ladder_command(self.LADDER[:1], 'dash', False, '128k')
+        self.assertEqual(output_files, {'master': 'manifest.mpd'})
+        self.assertNotIn("-map 0:a:0", cmd)
+        self.assertIn('-adaptation_sets "id=0,streams=v"', cmd)
+        self.assertTrue(cmd.endswith("{{master}}"))
+
+    def test_bitrate_kbps(self):
+        self.assertEqual([ffmpeg_execute.bitrate_kbps(value) for value in ('3000k', '3M', 3000000)], [3000.0, 3000.0, 3000.0])
+
+
+class SelectPresetTest(unittest.TestCase):
+
+    def info(self, audio_codec='aac', **video):
+        return {
+            'video': {'codec_name': 'h264', 'profile': 'High', 'pix_fmt': 'yuv420p', 'width': 1920, 'height': 1080,
+                      'bit_rate': '5000000', 'avg_frame_rate': '25/1', 'field_order': 'progressive', **video},
+            'audio': {'codec_name': audio_codec} if audio_codec else {},
+            'format': {}
+        }
+
+    def test_passthrough(self):
+        name, cmd, reasons = ffmpeg_execute.select_preset(self.info(), 'main')
+        self.assertEqual(name, 'passthrough')
+        self.assertEqual(cmd, "-map 0:v:0 -map 0:a:0? -c:v copy -c:a copy -movflags +faststart {{main}}")
+        self.assertEqual(reasons, ['video at target spec'])
+
+    def test_audio_transcode(self):
+        name, cmd, reasons = ffmpeg_execute.select_preset(self.info(audio_codec='mp3'))
+        self.assertEqual(name, 'audio_transcode')
+        self.assertIn("-c:v copy -c:a aac -b:a 128k", cmd)
+        self.assertTrue(cmd.endswith("{{output_files}}"))
+
+    def test_standard(self):
+        name, cmd, reasons = ffmpeg_execute.select_preset(self.info(codec_name='hevc', height=2160, width=3840, bit_rate='40000000'))
+        self.assertEqual(name, 'standard')
+        self.assertIn('-vf "scale=-2:1080" -c:v libx264 -preset veryfast', cmd)
+        self.assertEqual(reasons, ['video codec hevc', 'height 2160', 'bitrate 40000000'])
+
+    def test_quality(self):
+        name, cmd, reasons = ffmpeg_execute.select_preset(self.info(field_order='tt', pix_fmt='yuv422p10le'))
+        self.assertEqual(name, 'quality')
+        self.assertIn('-vf "yadif,deband=range=16:1thr=0.02:2thr=0.02:3thr=0.02" -c:v libx264 -preset medium', cmd)
+        self.assertEqual(reasons, ['pixel format yuv422p10le', 'interlaced (tt)'])
+
+    def test_low_bits_per_pixel(self):
+        # 0.02 bit per pixel at 1080p25
+        name, _, _ = ffmpeg_execute.select_preset(self.info(codec_name='mpeg2video', bit_rate=str(int(0.02 * 1920 * 1080 * 25))))
+        self.assertEqual(name, 'quality')
+
+
+if __name__ == '__main__':
+    unittest.main()
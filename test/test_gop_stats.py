@@ -0,0 +1,40 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "lambda", "ffmpeg-execute"))
+
+from frame_tables import FPS, frame_table
+
+
+class GopStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        # Two closed GOPs, then an open GOP starting on a non key I frame
+        self.table = frame_table([(pict_type, 1000) for pict_type in "IBBPBBIBBPiBP"])
+
+    def test_gop_structure(self):
+        self.assertEqual(self.table.gop_structure(), [
+            {'gop': 'IBBPBB', 'size': 6, 'status': 'CLOSED'},
+            {'gop': 'IBBP', 'size': 4, 'status': 'CLOSED'},
+            {'gop': 'iBP', 'size': 3, 'status': 'OPEN'}
+        ])
+
+    def test_gop_stats(self):
+        stats = self.table.gop_stats()
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual((stats['minSize'], stats['maxSize'], stats['meanSize']), (3, 6, 4.33))
+        self.assertEqual(stats['keyframeIntervals'], {'6': 1})
+        self.assertEqual(stats['keyframeIntervalSeconds']['mean'], round(6 / FPS, 3))
+        self.assertEqual(stats['closedRatio'], 0.667)
+        self.assertEqual(stats['bFrameRuns'], {'1': 1, '2': 3})
+
+    def test_gop_stats_without_decoding(self):
+        stats = self.table.gop_stats(decoded=False)
+        self.assertIsNone(stats['closedRatio'])
+        self.assertIsNone(stats['bFrameRuns'])
+
+
+if __name__ == '__main__':
+    unittest.main()
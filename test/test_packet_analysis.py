@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "lambda", "ffmpeg-execute"))
+
+from videotools_functions import FrameTable, VideoAnalyzer
+from frame_tables import FPS, frame_table
+
+
+class KeyframeTimesTest(unittest.TestCase):
+
+    def test_keyframe_times(self):
+        table = frame_table([(pict_type, 1000) for pict_type in "IBBPBBIBBPiBP"])
+        # The non key I frame is not a split point
+        self.assertEqual(table.keyframe_times(), [0.0, 6 / FPS])
+
+    def test_keyframe_times_use_pts(self):
+        # With B-frames the keyframe is decoded before it is shown: its DTS is earlier than its PTS
+        table = FrameTable()
+        table.append(0, {'key_frame': '1', 'pkt_dts_time': '9.9', 'pts_time': '10.0'})
+        table.append(1, {'key_frame': '1', 'pkt_dts_time': '-0.1', 'pts_time': '0.0'})
+        table.append(2, {'key_frame': '0', 'pkt_dts_time': '0.0', 'pts_time': '0.1'})
+        self.assertEqual(table.keyframe_times(), [0.0, 10.0])
+
+
+class PacketLinesTest(unittest.TestCase):
+
+    def test_packets_as_frames(self):
+        analyzer = VideoAnalyzer("input.mp4")
+        packets = [
+            {'codec_type': 'video', 'flags': 'K__', 'size': '5000', 'pos': '48', 'dts_time': '-0.04', 'pts_time': '0.0', 'duration_time': '0.04'},
+            {'codec_type': 'audio', 'flags': 'K__', 'size': '300', 'pos': '5048', 'dts_time': '0.0', 'pts_time': '0.0', 'duration_time': '0.021'},
+            {'codec_type': 'video', 'flags': '___', 'size': '800', 'pos': None, 'dts_time': '0.0', 'pts_time': '0.08', 'duration_time': '0.04'}
+        ]
+        with mock.patch.object(analyzer, "probe_lines", return_value=iter(packets)) as probe_lines:
+            frames = list(analyzer.analysis_lines("packets", read_intervals="%+30"))
+        entries, extra_args = probe_lines.call_args.args
+        self.assertEqual(entries, VideoAnalyzer.PACKET_ENTRIES)
+        self.assertEqual(extra_args, ["-read_intervals", "%+30", "-show_packets"])
+        self.assertEqual(frames[0], {
+            'media_type': 'video', 'key_frame': 1, 'pkt_size': '5000', 'pkt_pos': '48',
+            'pkt_dts_time': '-0.04', 'pts_time': '0.0', 'duration_time': '0.04', 'pict_type': 'I'
+        })
+        self.assertEqual(frames[1]['media_type'], 'audio')
+        # Picture types of non key packets are unknown without decoding
+        self.assertEqual((frames[2]['key_frame'], frames[2]['pict_type']), (0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
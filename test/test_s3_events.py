@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+from botocore.stub import ANY, Stubber
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from lambda_modules import load_lambda
+
+s3_events = load_lambda("ffmpeg-s3-events")
+
+
+def s3_record(key, etag='etag1', version=None):
+    s3_object = {'key': key, 'eTag': etag, **({'versionId': version} if version else {})}
+    return {'eventSource': 'aws:s3', 's3': {'bucket': {'name': 'bucket'}, 'object': s3_object}}
+
+
+class CollectUploadsTest(unittest.TestCase):
+
+    def test_direct_records(self):
+        uploads = s3_events.collect_uploads({'Records': [s3_record('in/my+video.mp4'), s3_record('in/other.mp4', 'etag2')]})
+        self.assertEqual([(upload['key'], upload['version'], upload['message_ids']) for upload in uploads],
+                         [('in/my video.mp4', 'etag1', set()), ('in/other.mp4', 'etag2', set())])
+
+    def test_sqs_batch_is_deduplicated(self):
+        # The same upload delivered in two SQS messages, a new upload of the same key, and an s3:TestEvent
+        event = {'Records': [
+            {'eventSource': 'aws:sqs', 'messageId': 'm1', 'body': json.dumps({'Records': [s3_record('video.mp4', version='v1')]})},
+            {'eventSource': 'aws:sqs', 'messageId': 'm2', 'body': json.dumps({'Records': [s3_record('video.mp4', version='v1')]})},
+            {'eventSource': 'aws:sqs', 'messageId': 'm3', 'body': json.dumps({'Records': [s3_record('video.mp4', 'etag2', 'v2')]})},
+            {'eventSource': 'aws:sqs', 'messageId': 'm4', 'body': json.dumps({'Event': 's3:TestEvent'})}
+        ]}
+        uploads = s3_events.collect_uploads(event)
+        self.assertEqual([(upload['version'], upload['etag'], upload['message_ids']) for upload in uploads],
+                         [('v1', 'etag1', {'m1', 'm2'}), ('v2', 'etag2', {'m3'})])
+
+
+class ClaimLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stubber = Stubber(s3_events.dynamodb)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        patcher = mock.patch.object(s3_events, 'LEDGER_TABLE', 'ledger')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claim_reclaims_expired_entries(self):
+        with mock.patch.object(s3_events.time, 'time', return_value=1000):
+            self.stubber.add_response('put_item', {}, {
+                'TableName': 'ledger',
+                'Item': ANY,
+                'ConditionExpression': 'attribute_not_exists(ledger_key) OR #ttl < :now OR (#status = :starting AND created < :stale)',
+                'ExpressionAttributeNames': {'#status': 'status', '#ttl': 'TTL'},
+                'ExpressionAttributeValues': {
+                    ':starting': {'S': 'starting'},
+                    ':stale': {'N': str(1000 - s3_events.LEDGER_LEASE_SECONDS)},
+                    ':now': {'N': '1000'}
+                }
+            })
+            entry, existing = s3_events.claim_ledger('bucket/key/etag/preset')
+        self.assertEqual(entry, {'key': 'bucket/key/etag/preset', 'created': 1000})
+        self.assertIsNone(existing)
+        self.stubber.assert_no_pending_responses()
+
+    def test_duplicate(self):
+        item = {'ledger_key': {'S': 'bucket/key/etag/preset'}, 'status': {'S': 'started'}}
+        self.stubber.add_client_error('put_item', 'ConditionalCheckFailedException')
+        self.stubber.add_response('get_item', {'Item': item})
+        entry, existing = s3_events.claim_ledger('bucket/key/etag/preset')
+        self.assertIsNone(entry)
+        self.assertEqual(existing, item)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import stat
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib", "lambda", "ffmpeg-execute"))
+
+from videotools_functions import AnalysisCache, ProbeError, VideoAnalyzer
+
+
+class ProbeLinesTest(unittest.TestCase):
+    # ffprobe is replaced by a script on the PATH printing two packets, then exiting with the given code
+
+    def setUp(self):
+        self.bin_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.bin_dir.cleanup)
+        path = f"{self.bin_dir.name}{os.pathsep}{os.environ.get('PATH', '')}"
+        patcher = mock.patch.dict(os.environ, {'PATH': path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_ffprobe(self, exit_code):
+        script = os.path.join(self.bin_dir.name, "ffprobe")
+        with open(script, "w") as file:
+            file.write("#!/bin/sh\n"
+                       "echo 'codec_type=video|flags=K__|size=100'\n"
+                       "echo 'codec_type=video|flags=___|size=N/A'\n"
+                       f"echo 'read error' >&2\nexit {exit_code}\n")
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+
+    def test_lines(self):
+        self.fake_ffprobe(0)
+        lines = list(VideoAnalyzer("input.mp4").probe_lines("packet=codec_type,flags,size"))
+        self.assertEqual(lines, [
+            {'codec_type': 'video', 'flags': 'K__', 'size': '100'},
+            {'codec_type': 'video', 'flags': '___', 'size': None}
+        ])
+
+    def test_failure_raises(self):
+        self.fake_ffprobe(1)
+        with self.assertRaisesRegex(ProbeError, "read error"):
+            list(VideoAnalyzer("input.mp4").probe_lines("packet=codec_type,flags,size"))
+
+    def test_failure_is_not_cached(self):
+        self.fake_ffprobe(1)
+        cache = AnalysisCache()
+        analyzer = VideoAnalyzer("input.mp4", cache=cache, identity="etag")
+        with mock.patch.object(analyzer, "stream_info", return_value={'video': {}, 'audio': {}, 'format': {}}):
+            with self.assertRaises(ProbeError):
+                analyzer.bitrate_report()
+        self.assertEqual(len(cache.entries), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
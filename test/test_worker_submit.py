@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from lambda_modules import load_lambda
+
+worker_submit = load_lambda("ffmpeg-worker-submit")
+
+
+class EstimateDurationTest(unittest.TestCase):
+
+    def estimate(self, command):
+        return worker_submit.estimate_duration({'ffmpeg_command': command, 'input_files': {}})
+
+    def test_parse_duration(self):
+        for value, seconds in [
+            ('10', 10.0), ('2.5', 2.5), ('1500ms', 1.5), ('250000us', 0.25), ('7s', 7.0),
+            ('00:10', 10.0), ('01:30.5', 90.5), ('00:10:00', 600.0), ('1:02:03', 3723.0)
+        ]:
+            self.assertEqual(worker_submit.parse_duration(value), seconds, value)
+
+    def test_unparseable_duration(self):
+        for value in ['-5', 'abc', '10min', '1:2:3:4', '']:
+            self.assertIsNone(worker_submit.parse_duration(value), value)
+
+    def test_clip_duration(self):
+        speed = worker_submit.SYNC_ENCODE_SPEED
+        self.assertEqual(self.estimate("-i {{in}} -t 00:10:00 -c:v libx264 {{out}}"), 600 / speed)
+        self.assertEqual(self.estimate("-ss 5 -t 1500ms -i {{in}} {{out}}"), 1.5 / speed)
+        # -to is an end position, not a duration
+        self.assertIsNone(worker_submit.OUTPUT_DURATION_PATTERN.search("-i {{in}} -to 10 {{out}}"))
+
+    def test_unparseable_clip_goes_async(self):
+        self.assertIsNone(self.estimate("-i {{in}} -t -00:10 {{out}}"))
+
+    def test_single_frame(self):
+        self.assertEqual(self.estimate("-i {{in}} -frames:v 1 -t 00:10:00 {{out}}"), 1.0)
+
+
+class ValidateJobTest(unittest.TestCase):
+
+    def job(self, **fields):
+        return {'stepFunction': 'arn', 'input_files': 's3://bucket/in.mp4', 'video_id': 'video',
+                'output_files': 'out.mp4', 'ffmpeg_command': '-c copy {{output_files}}', **fields}
+
+    def test_valid_job(self):
+        self.assertEqual(worker_submit.validate_job(self.job()), [])
+
+    def test_preset_auto_cannot_stream(self):
+        self.assertEqual(worker_submit.validate_job(self.job(preset='auto', output_mode='stream')),
+                         ["preset auto cannot be used with output_mode stream"])
+
+    def test_chunked_ladder(self):
+        self.assertEqual(worker_submit.validate_job(self.job(chunked=True, ladder=[{'name': '720p', 'height': 720}])),
+                         ["chunked cannot be used with ladder"])
+
+
+class BuildPayloadTest(unittest.TestCase):
+
+    def job(self, output_files):
+        return {'input_files': 's3://bucket/in.mp4', 'video_id': 'video', 'output_files': output_files,
+                'ffmpeg_command': '-c copy {{output_files}}', 'preset': 'auto'}
+
+    def test_single_output(self):
+        payload, output_urls = worker_submit.build_payload(self.job('out.mp4'), 'https://cdn', 'job')
+        self.assertEqual(payload['output_files'], {'output_files': 'out.mp4'})
+        self.assertEqual(output_urls, 'https://cdn/ffmpeg/video/out.mp4')
+        self.assertEqual(payload['preset'], 'auto')
+
+    def test_output_dict(self):
+        payload, output_urls = worker_submit.build_payload(self.job({'main': 'out.mp4'}), 'https://cdn', 'job')
+        self.assertEqual(payload['output_files'], {'main': 'out.mp4'})
+        self.assertEqual(output_urls, {'main': 'https://cdn/ffmpeg/video/out.mp4'})
+
+
+if __name__ == '__main__':
+    unittest.main()